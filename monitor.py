@@ -11,6 +11,8 @@ import wx
 import sys
 import threading
 
+import o2pop
+
 import builtins
 builtins.__dict__['_'] = wx.GetTranslation
 
@@ -112,6 +114,14 @@ class Monitor(wx.Dialog):
         button_clear = wx.Button(self, wx.ID_CLEAR, label=_("Clear"))
         button_clear.Bind(wx.EVT_BUTTON, self.on_clear)
 
+        button_queue = wx.Button(self, label=_("Queue"))
+        button_queue.SetToolTip(_("Show mails in the spool"))
+        button_queue.Bind(wx.EVT_BUTTON, self.on_queue)
+
+        button_trace = wx.Button(self, label=_("Trace"))
+        button_trace.SetToolTip(_("Show phase timings of recent sessions"))
+        button_trace.Bind(wx.EVT_BUTTON, self.on_trace)
+
         self.button_start = wx.Button(self, wx.ID_EXECUTE, label=_("Start"))
         self.button_start.Bind(wx.EVT_BUTTON, self.on_start)
 
@@ -131,6 +141,8 @@ class Monitor(wx.Dialog):
         hbox9.Add(text_level, flag=wx.ALIGN_CENTER_VERTICAL)
         hbox9.Add(self.choice, flag=wx.LEFT, border=5)
         hbox9.Add(button_clear, flag=wx.LEFT, border=30)
+        hbox9.Add(button_queue, flag=wx.LEFT, border=5)
+        hbox9.Add(button_trace, flag=wx.LEFT, border=5)
         hbox9.Add(self.button_start, flag=wx.LEFT, border=5)
         hbox9.Add(self.button_stop, flag=wx.LEFT, border=5)
         hbox9.Add(button_close, flag=wx.LEFT|wx.RIGHT, border=5)
@@ -145,6 +157,7 @@ class Monitor(wx.Dialog):
         # ----------------------------------------------------------
 
         parent.set_verbose(1)
+        o2pop.trace_enable()
 
         self.timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.on_timer, source=self.timer)
@@ -163,6 +176,12 @@ class Monitor(wx.Dialog):
     def on_clear(self, evt):
         self.logger.Clear()
 
+    def on_queue(self, evt):
+        o2pop.print_spool(self.parent.store_dir)
+
+    def on_trace(self, evt):
+        o2pop.print_trace()
+
     def on_start(self, evt):
         self.button_start.Enable(False)
         self.button_stop.Enable()
@@ -178,6 +197,7 @@ class Monitor(wx.Dialog):
 
     def on_close(self, evt):
         self.parent.set_verbose(0)
+        o2pop.trace_disable()
         if self.parent.start_check:
             self.parent.start_check = False
             self.parent.task_cancel(self.parent.task)
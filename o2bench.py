@@ -0,0 +1,375 @@
+#
+# o2bench.py (benchmark for o2pop)
+#
+# Copyright (c) 2020-2022 MURATA Yasuhisa
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+#
+# Runs o2pop against local stand-in POP3 / IMAP / SMTP servers (TLS with a
+# self-signed certificate made by openssl, XOAUTH2 with a fixed token) and
+# reports connections/sec, login latency and relay throughput per protocol.
+#
+#   python o2bench.py -n 20 -s 10 --size 1000000 -- --pop_engine --imap_compress
+#
+# Arguments after '--' are passed to o2pop.
+#
+
+import asyncio
+import ssl
+import sys
+import os
+import socket
+import argparse
+import subprocess
+import tempfile
+import shutil
+import base64
+import json
+import time
+
+TOKEN = 'o2bench-token'
+PASSWORD = b'o2bench'
+
+def parse_args():
+    argv = sys.argv[1:]
+    proxy_argv = []
+    if '--' in argv:
+        i = argv.index('--')
+        argv, proxy_argv = argv[:i], argv[i + 1:]
+    parser = argparse.ArgumentParser(prog='o2bench', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-n", "--clients", metavar='N', type=int, default=10,
+        help="concurrent clients per protocol (default: %(default)s)")
+    parser.add_argument("-s", "--sessions", metavar='N', type=int, default=20,
+        help="sessions per client (default: %(default)s)")
+    parser.add_argument("--accounts", metavar='N', type=int, default=0,
+        help="accounts shared by the clients (default: %(default)s, 0: one per client)")
+    parser.add_argument("--size", metavar='BYTES', type=int, default=100000,
+        help="size of the message retrieved or sent in a session (default: %(default)s)")
+    parser.add_argument("--proto", nargs='+', choices=['pop', 'imap', 'smtp'],
+        default=['pop', 'imap', 'smtp'], help="protocols to run (default: all)")
+    args = parser.parse_args(argv)
+    return args, proxy_argv
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def make_cert(path):
+    cert = os.path.join(path, 'cert.pem')
+    key = os.path.join(path, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+        '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+        '-keyout', key, '-out', cert], check=True, capture_output=True)
+    return cert, key
+
+def make_message(size):
+    line = b'o2bench ' + b'x' * 66 + b'\r\n'
+    header = b'From: bench@example.com\r\nTo: bench@example.com\r\nSubject: o2bench\r\n\r\n'
+    n = max(size - len(header), 0) // len(line) + 1
+    return header + line * n
+
+def check_xoauth2(b64):
+    try:
+        s = base64.b64decode(b64)
+    except ValueError:
+        return False
+    return s.startswith(b'user=') and b'\1auth=Bearer ' + TOKEN.encode() + b'\1\1' in s
+
+# stand-in servers
+
+async def fake_pop(reader, writer):
+    writer.write(b'+OK o2bench POP3 ready\r\n')
+    while True:
+        s = await reader.readline()
+        if not s:
+            break
+        t = s.split()
+        cmd = t[0].upper() if t else b''
+        if cmd == b'AUTH':
+            ok = len(t) == 3 and check_xoauth2(t[2])
+            writer.write(b'+OK Welcome.\r\n' if ok else b'-ERR [AUTH] Invalid credentials.\r\n')
+        elif cmd == b'CAPA':
+            writer.write(b'+OK\r\nUSER\r\nTOP\r\nUIDL\r\nPIPELINING\r\n.\r\n')
+        elif cmd == b'STAT':
+            writer.write(b'+OK 1 %d\r\n' % len(MESSAGE))
+        elif cmd in (b'LIST', b'UIDL'):
+            v = b'%d' % len(MESSAGE) if cmd == b'LIST' else b'o2bench1'
+            if len(t) > 1:
+                writer.write(b'+OK 1 %b\r\n' % v)
+            else:
+                writer.write(b'+OK\r\n1 %b\r\n.\r\n' % v)
+        elif cmd == b'RETR':
+            if t[1:] == [b'1']:
+                writer.write(b'+OK %d octets\r\n' % len(MESSAGE))
+                writer.write(MESSAGE)
+                writer.write(b'.\r\n')
+            else:
+                writer.write(b'-ERR no such message\r\n')
+        elif cmd in (b'NOOP', b'DELE', b'RSET'):
+            writer.write(b'+OK\r\n')
+        elif cmd == b'QUIT':
+            writer.write(b'+OK Farewell.\r\n')
+            await writer.drain()
+            break
+        else:
+            writer.write(b'-ERR unknown command\r\n')
+        await writer.drain()
+    writer.close()
+
+async def fake_imap(reader, writer):
+    import o2pop
+    writer.write(b'* OK o2bench IMAP ready\r\n')
+    while True:
+        s = await reader.readline()
+        if not s:
+            break
+        t = s.split()
+        if len(t) < 2:
+            writer.write(b'* BAD malformed\r\n')
+            await writer.drain()
+            continue
+        tag, cmd = t[0], t[1].upper()
+        if cmd == b'AUTHENTICATE':
+            ok = len(t) == 4 and check_xoauth2(t[3])
+            writer.write(tag + (b' OK Success\r\n' if ok else b' NO [AUTHENTICATIONFAILED] Invalid credentials\r\n'))
+        elif cmd == b'CAPABILITY':
+            writer.write(b'* CAPABILITY IMAP4rev1 UNSELECT IDLE NAMESPACE QUOTA CHILDREN COMPRESS=DEFLATE\r\n'
+                + tag + b' OK Success\r\n')
+        elif cmd == b'COMPRESS':
+            writer.write(tag + b' OK Success\r\n')
+            await writer.drain()
+            deflate = o2pop.Deflate(reader, writer)
+            reader, writer = deflate.reader, deflate
+            continue
+        elif cmd in (b'SELECT', b'EXAMINE'):
+            writer.write(b'* FLAGS (\\Seen)\r\n* 1 EXISTS\r\n* 0 RECENT\r\n' + tag + b' OK [READ-WRITE] Success\r\n')
+        elif cmd == b'FETCH' or (cmd == b'UID' and t[2:3] == [b'FETCH']):
+            writer.write(b'* 1 FETCH (UID 1 BODY[] {%d}\r\n' % len(MESSAGE))
+            writer.write(MESSAGE)
+            writer.write(b')\r\n' + tag + b' OK Success\r\n')
+        elif cmd in (b'NOOP', b'CLOSE', b'UNSELECT', b'CHECK'):
+            writer.write(tag + b' OK Success\r\n')
+        elif cmd == b'LOGOUT':
+            writer.write(b'* BYE LOGOUT Requested\r\n' + tag + b' OK 73 good day (Success)\r\n')
+            await writer.drain()
+            break
+        else:
+            writer.write(tag + b' BAD Unknown command\r\n')
+        await writer.drain()
+    writer.close()
+
+async def fake_smtp(reader, writer):
+    writer.write(b'220 o2bench ESMTP ready\r\n')
+    while True:
+        s = await reader.readline()
+        if not s:
+            break
+        t = s.split()
+        cmd = t[0].upper() if t else b''
+        if cmd == b'EHLO':
+            writer.write(b'250-o2bench\r\n250-SIZE 35882577\r\n250-8BITMIME\r\n250-PIPELINING\r\n'
+                b'250-CHUNKING\r\n250 AUTH LOGIN PLAIN XOAUTH2\r\n')
+        elif cmd == b'AUTH':
+            ok = len(t) == 3 and check_xoauth2(t[2])
+            writer.write(b'235 2.7.0 Accepted\r\n' if ok else b'535 5.7.8 Username and Password not accepted\r\n')
+        elif cmd in (b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+            writer.write(b'250 2.1.0 OK\r\n')
+        elif cmd == b'DATA':
+            writer.write(b'354 Go ahead\r\n')
+            await writer.drain()
+            await reader.readuntil(b'\r\n.\r\n')
+            writer.write(b'250 2.0.0 OK queued\r\n')
+        elif cmd == b'BDAT':
+            await reader.readexactly(int(t[1]))
+            writer.write(b'250 2.0.0 OK\r\n')
+        elif cmd == b'QUIT':
+            writer.write(b'221 2.0.0 closing connection\r\n')
+            await writer.drain()
+            break
+        else:
+            writer.write(b'502 5.5.1 Unrecognized command\r\n')
+        await writer.drain()
+    writer.close()
+
+# clients; each returns (login sec, payload bytes)
+
+async def expect(reader, prefix):
+    s = await reader.readline()
+    if not s.startswith(prefix):
+        raise RuntimeError(s.decode(errors='replace').strip() or 'connection closed')
+    return s
+
+async def pop_client(port, user):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=LIMIT)
+    try:
+        start = time.perf_counter()
+        await expect(reader, b'+OK')
+        writer.write(b'USER ' + user + b'\r\n')
+        await expect(reader, b'+OK')
+        writer.write(b'PASS ' + PASSWORD + b'\r\n')
+        await expect(reader, b'+OK')
+        login = time.perf_counter() - start
+        writer.write(b'RETR 1\r\n')
+        await expect(reader, b'+OK')
+        n = len(await reader.readuntil(b'\r\n.\r\n'))
+        writer.write(b'QUIT\r\n')
+        await expect(reader, b'+OK')
+        return login, n
+    finally:
+        writer.close()
+
+async def imap_client(port, user):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=LIMIT)
+    try:
+        start = time.perf_counter()
+        await expect(reader, b'* OK')
+        writer.write(b'a1 LOGIN ' + user + b' ' + PASSWORD + b'\r\n')
+        await expect(reader, b'a1 OK')
+        login = time.perf_counter() - start
+        writer.write(b'a2 SELECT INBOX\r\n')
+        while not (await reader.readline()).startswith(b'a2 '):
+            pass
+        writer.write(b'a3 UID FETCH 1 BODY[]\r\n') # --imap_mux refuses sequence numbers
+        s = await expect(reader, b'* 1 FETCH')
+        size = int(s.rstrip()[s.rfind(b'{') + 1:-1])
+        n = len(await reader.readexactly(size))
+        await expect(reader, b')')
+        await expect(reader, b'a3 OK')
+        writer.write(b'a4 LOGOUT\r\n')
+        while not (await reader.readline()).startswith(b'a4 '):
+            pass
+        return login, n
+    finally:
+        writer.close()
+
+async def smtp_reply(reader, prefix):
+    while True:
+        s = await reader.readline()
+        if s[3:4] != b'-':
+            break
+    if not s.startswith(prefix):
+        raise RuntimeError(s.decode(errors='replace').strip() or 'connection closed')
+
+async def smtp_client(port, user):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=LIMIT)
+    try:
+        start = time.perf_counter()
+        await smtp_reply(reader, b'220')
+        writer.write(b'EHLO o2bench\r\n')
+        await smtp_reply(reader, b'250')
+        writer.write(b'AUTH PLAIN ' + base64.b64encode(b'\0' + user + b'\0' + PASSWORD) + b'\r\n')
+        await smtp_reply(reader, b'235')
+        login = time.perf_counter() - start
+        writer.write(b'MAIL FROM:<' + user + b'>\r\n')
+        await smtp_reply(reader, b'250')
+        writer.write(b'RCPT TO:<bench@example.com>\r\n')
+        await smtp_reply(reader, b'250')
+        writer.write(b'DATA\r\n')
+        await smtp_reply(reader, b'354')
+        writer.write(MESSAGE + b'.\r\n')
+        await smtp_reply(reader, b'250')
+        writer.write(b'QUIT\r\n')
+        await smtp_reply(reader, b'221')
+        return login, len(MESSAGE)
+    finally:
+        writer.close()
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+async def run_proto(name, client, port, opts):
+    logins = []
+    errors = []
+    total = 0
+
+    async def worker(i):
+        nonlocal total
+        account = i % opts.accounts if opts.accounts > 0 else i
+        user = b'bench%d@example.com' % account
+        for _ in range(opts.sessions):
+            try:
+                login, n = await client(port, user)
+                logins.append(login)
+                total += n
+            except (OSError, RuntimeError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as ex:
+                errors.append(ex)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(opts.clients)))
+    elapsed = time.perf_counter() - start
+    print(f'{name:5} {len(logins):9} {len(errors):7} {len(logins) / elapsed:9.1f} '
+        f'{percentile(logins, 0.5) * 1000:13.2f} {percentile(logins, 0.99) * 1000:13.2f} '
+        f'{total / elapsed / 1e6:9.1f}')
+    if errors:
+        print(f'      first error: {type(errors[0]).__name__}: {errors[0]}')
+
+async def main(opts, proxy_argv):
+    global MESSAGE, LIMIT
+    MESSAGE = make_message(opts.size)
+    LIMIT = 2 * len(MESSAGE) + 65536 # a whole message is read with readuntil()
+    work = tempfile.mkdtemp(prefix='o2bench-')
+    cert, key = make_cert(work)
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ctx.load_cert_chain(cert, key)
+
+    servers = {}
+    for name, handle in (('pop', fake_pop), ('imap', fake_imap), ('smtp', fake_smtp)):
+        servers[name] = await asyncio.start_server(handle, 'localhost', 0, ssl=ctx, limit=LIMIT)
+    upstream = {name: server.sockets[0].getsockname()[1] for name, server in servers.items()}
+
+    secret = os.path.join(work, 'client_secret.json')
+    with open(secret, 'w') as f:
+        json.dump({'installed': {
+            'client_id': 'o2bench', 'client_secret': 'o2bench',
+            'auth_uri': 'https://localhost/auth', 'token_uri': 'https://localhost/token',
+            '_pop_server': f"localhost:{upstream['pop']}",
+            '_imap_server': f"localhost:{upstream['imap']}",
+            '_smtp_server': f"localhost:{upstream['smtp']}",
+        }}, f)
+
+    ports = {name: free_port() for name in opts.proto}
+    sys.argv = ['o2pop', '-f', secret, '--ca_file', cert]
+    for name, port in ports.items():
+        sys.argv += ['--' + name, str(port)]
+    sys.argv += proxy_argv
+
+    import o2pop
+    o2pop.params_main.store_dir = work
+    o2pop.Params.get_token = lambda self, user, login_hint=None, margin=0, refresh_only=False, timing=None: TOKEN
+
+    proxy = asyncio.create_task(o2pop.main())
+    for port in ports.values():
+        for _ in range(100):
+            try:
+                _, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.05)
+
+    print(f'{opts.clients} clients x {opts.sessions} sessions, {len(MESSAGE)} bytes per message')
+    print('proto  sessions  errors    conn/s  login p50 ms  login p99 ms      MB/s')
+    clients = {'pop': pop_client, 'imap': imap_client, 'smtp': smtp_client}
+    try:
+        for name in opts.proto:
+            await run_proto(name, clients[name], ports[name], opts)
+    finally:
+        proxy.cancel()
+        try:
+            await proxy
+        except asyncio.CancelledError:
+            pass
+        for server in servers.values():
+            server.close()
+        shutil.rmtree(work, ignore_errors=True)
+
+if __name__ == '__main__':
+    opts, proxy_argv = parse_args()
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    asyncio.run(main(opts, proxy_argv))
@@ -13,11 +13,22 @@ import sys
 import socket
 import argparse
 import time
+import datetime
 
 import pickle
 import os
 import base64
 import json
+import concurrent.futures
+import tempfile
+import shutil
+import hashlib
+import mmap
+import zlib
+import bisect
+import collections
+import queue
+import threading
 from google.auth import transport
 
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -50,12 +61,201 @@ LOCAL_SMTP_PORT = 8025
 
 MS_MODE = 1
 
+TOKEN_WORKERS = 4
+TOKEN_TIMEOUT = 300 # sec (includes interactive login)
+CONNECT_TIMEOUT = 30 # sec, server connection and TLS handshake
+LOGIN_TIMEOUT = 60 # sec, from the client connection to its authentication
+SERVER_TIMEOUT = 120 # sec, waiting for a server reply
+IDLE_TIMEOUT = 1800 # sec, no data from the client (or either side while relaying)
+REFRESH_MARGIN = 300 # sec
+REFRESH_INTERVAL = 60 # sec
+
+BUFFER_SIZE = 65536
+WRITE_HIGH_FACTOR = 4 # high-water mark = buffer_size * WRITE_HIGH_FACTOR
+TAP_QUEUE_SIZE = 256 # chunks
+SPOOL_SIZE = 1024 * 1024 # bytes kept in memory before spilling to a temp file
+
+SMTP_NOOP_INTERVAL = 60 # sec
+SMTP_POOL_IDLE = 300 # sec
+SMTP_SIZE = 35882577 # bytes, same as smtp.gmail.com
+HOLD_TIMEOUT = 60 # sec
+SPOOL_RETRY = 60 # sec, doubled after each failure
+SPOOL_RETRY_MAX = 3600 # sec
+SPOOL_EXPIRE = 3 * 24 * 3600 # sec
+IMAP_IDLE_POLL = 30 # sec
+IMAP_NOOP_INTERVAL = 300 # sec
+POP_PIPELINE = 16 # client commands sent upstream at a time (--pop_engine)
+POP_PREFETCH_SIZE = 8 * 1024 * 1024 # bytes (by LIST), larger messages are not prefetched
+POP_LINE_MAX = 65536 # bytes of a client command line
+ZLIB_INLINE = 4096 # bytes (de)compressed on the event loop, larger chunks in a thread
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30) # sec
+TRACE_SIZE = 1000 # sessions kept by --trace in the Monitor
+TRACE_PHASES = 32 # phases kept per session; later ones are added up by name
+
+class TokenError(Exception):
+    pass
+
+class LimitError(Exception):
+    pass
+
+class AuthLock:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.owner = -1
+
+    async def acquire(self, count):
+        await self.lock.acquire()
+        self.owner = count
+
+    def release(self):
+        self.owner = -1
+        self.lock.release()
+
+class TimedReader(asyncio.StreamReader):
+    # raises TimeoutError (an OSError) when no data comes for timeout sec
+    # while a read is waiting (0: no timeout); hooks the asyncio internals
+    # _wait_for_data() and _waiter, reads are not timed without them
+    def __init__(self, timeout, limit=2**16):
+        super().__init__(limit)
+        self.timeout = timeout
+
+    async def _wait_for_data(self, func_name):
+        if self.timeout <= 0:
+            return await super()._wait_for_data(func_name)
+        # a timer, not wait_for(): data fed before a new task ran would be missed
+        timer = asyncio.get_running_loop().call_later(self.timeout, self.expire)
+        try:
+            await super()._wait_for_data(func_name)
+        finally:
+            timer.cancel()
+
+    def expire(self):
+        waiter = getattr(self, '_waiter', None) # an asyncio internal
+        if waiter and not waiter.done():
+            waiter.set_exception(TimeoutError(f'No data for {self.timeout}s'))
+
+# concurrency cap per key (None: global) with a bounded FIFO of waiters;
+# a slot freed by leave() goes straight to the first waiter
+class Limiter:
+    def __init__(self, name, limit, queue):
+        self.name = name
+        self.limit = limit # 0: no limit
+        self.queue = queue
+        self.active = {} # key -> count
+        self.waiters = {} # key -> deque of futures
+
+    # False: the queue is full or the wait timed out
+    async def enter(self, key=None):
+        if self.limit <= 0:
+            return True
+        n = self.active.get(key, 0)
+        waiters = self.waiters.setdefault(key, collections.deque())
+        if n < self.limit and not waiters:
+            self.active[key] = n + 1
+            return True
+        if len(waiters) >= self.queue:
+            metrics.inc('o2pop_rejected_total', limit=self.name)
+            return False
+        fut = asyncio.get_running_loop().create_future()
+        waiters.append(fut)
+        t = time.monotonic()
+        try:
+            await asyncio.wait_for(fut, args.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            metrics.inc('o2pop_rejected_total', limit=self.name)
+            return False
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.leave(key)
+            raise
+        finally:
+            metrics.observe('o2pop_queue_wait_seconds', time.monotonic() - t, queue=self.name)
+            if fut in waiters:
+                waiters.remove(fut)
+
+    def leave(self, key=None):
+        if self.limit <= 0:
+            return
+        waiters = self.waiters.get(key)
+        while waiters:
+            fut = waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        n = self.active.get(key, 0) - 1
+        if n > 0:
+            self.active[key] = n
+        else:
+            self.active.pop(key, None)
+            self.waiters.pop(key, None)
+
+session_limit = None # local sessions
+account_limit = None # local sessions per account
+upstream_limit = None # server connections
+account_upstream_limit = None # server connections per account
+
+# await aw for timeout sec at most (0: no timeout)
+async def wait_timeout(aw, timeout, what):
+    if timeout <= 0:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f'{what}: timeout ({timeout}s)') from None
+
+# drain() that raises TimeoutError when the peer reads nothing for timeout
+# sec (0: no timeout); no timer while the write buffer is under its low mark
+async def timed_drain(writer, timeout):
+    try:
+        transport = writer.transport
+        idle = transport.get_write_buffer_size() <= transport.get_write_buffer_limits()[0]
+    except (AttributeError, NotImplementedError): # Deflate, TLS of Python 3.7
+        idle = False
+    if timeout <= 0 or idle:
+        return await writer.drain()
+    await wait_timeout(writer.drain(), timeout, 'Write')
+
+# open a server connection within upstream_limit / account_upstream_limit;
+# the slots are freed when the connection is closed
+async def open_upstream(host, port, ctx, account):
+    if not await upstream_limit.enter():
+        raise LimitError('Too many server connections')
+    if not await account_upstream_limit.enter(account):
+        upstream_limit.leave()
+        raise LimitError(f'Too many server connections: {account}')
+    loop = asyncio.get_running_loop()
+    reader = TimedReader(args.server_timeout)
+    try:
+        transport, protocol = await wait_timeout(loop.create_connection(
+            lambda: asyncio.StreamReaderProtocol(reader), host, port, ssl=ctx),
+            args.connect_timeout, f'Connect to {host}:{port}')
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    except BaseException:
+        upstream_limit.leave()
+        account_upstream_limit.leave(account)
+        raise
+
+    def closed(task):
+        if not task.cancelled():
+            task.exception()
+        upstream_limit.leave()
+        account_upstream_limit.leave(account)
+    asyncio.ensure_future(writer.wait_closed()).add_done_callback(closed)
+    return reader, writer
+
 class Conn:
     count = -1
-    lock = -1
+    locks = {} # token file -> AuthLock
     def __init__(self):
         self.reader = None
         self.writer = None
+        self.lock = None
+        self.deflate = None
+        self.user = b''
+        self.account = None # key of account_limit while entered
+        self.trace = None
+        self.login_timer = None
         if Conn.count < 99:
             Conn.count += 1
         else:
@@ -65,43 +265,560 @@ class Conn:
     def print2(self, label, s):
         print(f'{label}[{self.count}] {s}')
 
-async def pipe(reader, writer, direction, count):
-    try:
-        if args.verbose:
-            if direction == 1:
-                label = f'>>>[{count}]'
-            else:
-                label = f'<<<[{count}]'
-            while not reader.at_eof():
-                s = await reader.readline()
-                print(f'{label} {s}')
-                writer.write(s)
+    # phase tracing (--trace): the time since the last phase() goes to the
+    # current phase; a no-op unless trace_begin() found tracing enabled
+    def trace_begin(self, proto):
+        if traces is None:
+            return
+        # keep the deque: trace_disable() may drop the global mid-session
+        self.traces = traces
+        self.trace = []
+        self.proto = proto
+        self.started = time.time()
+        self.mark = time.monotonic()
+        self.current = 'greeting'
+
+    def phase(self, name):
+        if name != 'client_auth':
+            self.logged_in()
+        trace = self.trace
+        if trace is None:
+            return
+        now = time.monotonic()
+        t = now - self.mark
+        if trace and trace[-1][0] == self.current:
+            trace[-1][1] += t
+        elif len(trace) < TRACE_PHASES:
+            trace.append([self.current, t])
         else:
-            while not reader.at_eof():
-                writer.write(await reader.read(2048))
-    except Exception as ex: # debug
+            for p in trace:
+                if p[0] == self.current:
+                    p[1] += t
+                    break
+        self.current = name
+        self.mark = now
+
+    def trace_end(self):
+        if self.trace is None:
+            return
+        self.phase(None)
+        self.traces.append((self.started, self.count, self.proto, self.user, self.trace))
+        self.trace = None
+
+    # slow-loris protection: abort the client connection unless it is
+    # authenticated (a phase after client_auth begins) within timeout sec
+    def login_deadline(self, transport, timeout):
+        if timeout > 0:
+            loop = asyncio.get_running_loop()
+            self.login_timer = loop.call_later(timeout, self.login_expired, transport, timeout)
+
+    def login_expired(self, transport, timeout):
+        self.login_timer = None
+        metrics.inc('o2pop_login_timeouts_total')
         if args.verbose:
-            print(f'[{count}] ({direction}) {sys.exc_info()[0].__name__}: {ex}')
+            print(f'[{self.count}] Login timeout ({timeout}s)')
+        transport.abort()
+
+    def logged_in(self):
+        if self.login_timer:
+            self.login_timer.cancel()
+            self.login_timer = None
+
+    async def acquire(self, key):
+        # one token fetch / refresh per account at a time, released before
+        # connecting upstream; other accounts are not blocked
+        lock = Conn.locks.get(key)
+        if lock is None:
+            lock = Conn.locks[key] = AuthLock()
+        if args.verbose and lock.owner >= 0:
+            print(f'[{self.count}] Locked by [{lock.owner}]') # debug
+        self.phase('lock')
+        t = time.monotonic()
+        await lock.acquire(self.count)
+        metrics.observe('o2pop_lock_wait_seconds', time.monotonic() - t)
+        self.phase('token')
+        self.lock = lock
+
+    def release(self):
+        if self.lock:
+            self.lock.release()
+            self.lock = None
+
+class ResumableContext(ssl.SSLContext):
+    # offer the last session to the server (TLS session resumption)
+    session = None
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.session
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+ssl_contexts = {} # (host, ca_file) -> ResumableContext
+
+def get_ssl_context(host):
+    key = (host, args.ca_file)
+    ctx = ssl_contexts.get(key)
+    if ctx is None:
+        ctx = ResumableContext(ssl.PROTOCOL_TLS_CLIENT)
+        ctx.load_default_certs()
+        if args.ca_file: # in addition to the system ones
+            ctx.load_verify_locations(cafile=args.ca_file)
+        ssl_contexts[key] = ctx
+    return ctx
+
+def save_ssl_session(ctx, writer, count):
+    ssl_object = writer.get_extra_info('ssl_object')
+    if not ssl_object:
+        return
+    if args.verbose: # debug
+        print(f'[{count}] TLS session reused: {ssl_object.session_reused}')
+    if ssl_object.session:
+        ctx.session = ssl_object.session
+
+def set_write_limits(transport):
+    size = args.buffer_size
+    transport.set_write_buffer_limits(high=size * WRITE_HIGH_FACTOR, low=size)
+
+# verbose log of relayed data; lines are split and printed by a separate
+# thread, and chunks are dropped (o2pop_tap_dropped_total) when it falls behind
+class Tap:
+    def __init__(self):
+        self.queue = queue.Queue(TAP_QUEUE_SIZE)
+        self.dropped = {} # label -> chunks dropped since the last one queued
+        self.dropped_total = metrics.counter('o2pop_tap_dropped_total')
+        self.thread = None
+
+    # on the event loop only; never blocks, drops when the printer lags
+    def put(self, label, data):
+        n = self.dropped.get(label, 0)
+        try:
+            self.queue.put_nowait((label, data, n))
+        except queue.Full:
+            self.dropped[label] = n + 1
+            self.dropped_total[0] += 1
+            return
+        if n:
+            del self.dropped[label]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread = None
+
+    # formats and prints in its own thread
+    def run(self):
+        partial = {}
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            label, data, n = item
+            if n:
+                partial.pop(label, None)
+                print(f'{label} --- {n} chunk(s) dropped ---')
+
+            s = partial.pop(label, b'') + (data or b'')
+            lines = s.splitlines(keepends=True)
+            if data and lines and not lines[-1].endswith(b'\n') and len(lines[-1]) < args.buffer_size:
+                partial[label] = lines.pop()
+            for t in lines:
+                print(f'{label} {t}')
+
+tap = None
+
+# counters, gauges and histograms served on --metrics_port in the Prometheus
+# text format; a counter or gauge is a one-item list so hot paths can keep it
+class Metrics:
+    def __init__(self):
+        self.types = {} # name -> counter / gauge / histogram
+        self.values = {} # (name, labels) -> [value]
+        self.histograms = {} # (name, labels) -> [count per bucket ... +Inf, sum]
+
+    def get(self, kind, name, labels):
+        self.types.setdefault(name, kind)
+        key = (name, tuple(sorted(labels.items())))
+        v = self.values.get(key)
+        if v is None:
+            v = self.values[key] = [0]
+        return v
+
+    def counter(self, name, **labels):
+        return self.get('counter', name, labels)
+
+    def gauge(self, name, **labels):
+        return self.get('gauge', name, labels)
+
+    def inc(self, name, n=1, **labels):
+        self.get('counter', name, labels)[0] += n
+
+    def observe(self, name, value, **labels):
+        self.types.setdefault(name, 'histogram')
+        key = (name, tuple(sorted(labels.items())))
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = [0] * (len(METRICS_BUCKETS) + 2)
+        h[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        h[-1] += value
+
+    def render(self):
+        def fmt(name, labels, value):
+            if labels:
+                name += '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+            return f'{name} {value}\n'
+
+        out = []
+        for name, kind in sorted(self.types.items()):
+            out.append(f'# TYPE {name} {kind}\n')
+            for (n, labels), v in sorted(self.values.items()):
+                if n == name:
+                    out.append(fmt(name, labels, v[0]))
+            for (n, labels), h in sorted(self.histograms.items()):
+                if n != name:
+                    continue
+                total = 0
+                for le, c in zip(METRICS_BUCKETS + ('+Inf',), h):
+                    total += c
+                    out.append(fmt(name + '_bucket', labels + (('le', le),), total))
+                out.append(fmt(name + '_sum', labels, round(h[-1], 6)))
+                out.append(fmt(name + '_count', labels, total))
+
+        # per-command latency of --pop_engine / --pop_cache sessions
+        if pop_stats:
+            out.append('# TYPE o2pop_pop_command_seconds summary\n')
+            for cmd, st in sorted(pop_stats.items()):
+                labels = (('command', cmd),)
+                out.append(fmt('o2pop_pop_command_seconds_sum', labels, round(st[1], 6)))
+                out.append(fmt('o2pop_pop_command_seconds_count', labels, st[0]))
+        return ''.join(out)
+
+metrics = None
+
+# finished sessions: (start time, count, proto, user, [[phase, sec] ...])
+traces = None
+
+def trace_enable(size=TRACE_SIZE):
+    global traces
+    if traces is None:
+        traces = collections.deque(maxlen=size)
+
+# stop tracing enabled by trace_enable(), unless --trace asked for it
+def trace_disable():
+    global traces
+    if args.trace <= 0:
+        traces = None
+
+def format_trace():
+    if traces is None:
+        return ['trace: disabled']
+    out = []
+    for started, count, proto, user, trace in list(traces):
+        total = sum(t for _, t in trace)
+        phases = ', '.join(f'{name} {t * 1000:.1f}' for name, t in trace)
+        out.append(f"{time.strftime('%H:%M:%S', time.localtime(started))} [{count}] {proto} "
+            f"{user.decode(errors='replace')} {total * 1000:.1f} ms: {phases}")
+    return out or ['trace: empty']
+
+def print_trace():
+    for s in format_trace():
+        print(s)
+
+# GET /metrics, GET /trace
+async def handle_metrics(reader, writer):
+    try:
+        s = await reader.readline()
+        while True:
+            t = await reader.readline()
+            if t in (b'\r\n', b'\n', b''):
+                break
+        t = s.split()
+        path = t[1].split(b'?')[0] if len(t) >= 2 and t[0] == b'GET' else b''
+        if path == b'/metrics':
+            status = b'200 OK'
+            body = metrics.render().encode()
+        elif path == b'/trace':
+            status = b'200 OK'
+            body = ''.join(s + '\n' for s in format_trace()).encode()
+        else:
+            status = b'404 Not Found'
+            body = b'Not Found\n'
+        writer.write(b'HTTP/1.0 %b\r\nContent-Type: text/plain; version=0.0.4\r\n'
+            b'Content-Length: %d\r\n\r\n' % (status, len(body)) + body)
+        await writer.drain()
+    except (OSError, ValueError, asyncio.LimitOverrunError):
+        pass
     finally:
         writer.close()
 
-async def handle_common(local_reader, local_writer, init_func):
+class Relay(asyncio.BufferedProtocol):
+    # forwards data read from its transport to the peer's transport
+    def __init__(self, transport, done, label, nbytes):
+        self.transport = transport
+        self.label = label
+        self.peer = None
+        self.done = done
+        self.buffer = memoryview(bytearray(args.buffer_size))
+        self.nbytes = nbytes # metrics counter of the bytes read
+        self.closed = False
+        self.stream = None # protocol replaced by start()
+        self.last = time.monotonic() # time of the last data read
+
+    # data, eof: what the StreamReader had read (stream_handoff())
+    def start(self, data, eof):
+        transport = self.transport
+        set_write_limits(transport)
+        self.stream = transport.get_protocol()
+        transport.set_protocol(self)
+
+        if data:
+            self.nbytes[0] += len(data)
+            self.peer.transport.write(data)
+
+        if transport.is_closing():
+            self.connection_lost(None)
+        elif eof:
+            transport.close()
+        elif not transport.is_reading():
+            transport.resume_reading()
+
+    def get_buffer(self, sizehint):
+        return self.buffer
+
+    def buffer_updated(self, nbytes):
+        self.last = time.monotonic()
+        self.nbytes[0] += nbytes
+        data = bytes(self.buffer[:nbytes])
+        self.peer.transport.write(data)
+        if args.verbose:
+            tap.put(self.label, data)
+
+    def eof_received(self):
+        self.peer.transport.close()
+        return False
+
+    # called for our transport's write buffer, which is fed by the peer
+    def pause_writing(self):
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if self.closed:
+            return
+        self.closed = True
+        self.peer.transport.close()
+        # so that the writer's wait_closed() returns
+        if self.stream:
+            self.stream.connection_lost(exc)
+        if args.verbose:
+            tap.put(self.label, None)
+        if self.peer.closed and not self.done.done():
+            self.done.set_result(None)
+
+# what a StreamReader has read but not returned (during the login phase) and
+# whether it has seen EOF, for handing its transport over to a Relay; these
+# are asyncio internals, so None if this Python's StreamReader lacks them
+def stream_handoff(reader, writer):
+    buffer = getattr(reader, '_buffer', None)
+    eof = getattr(reader, '_eof', None)
+    transport = getattr(writer, 'transport', None)
+    if not isinstance(buffer, bytearray) or not isinstance(eof, bool) or not all(
+            hasattr(transport, name) for name in ('get_protocol', 'set_protocol', 'is_reading')):
+        return None
+    return bytes(buffer), eof
+
+async def relay(local_reader, local_writer, remote_reader, remote_writer, count, proto):
+    local_state = stream_handoff(local_reader, local_writer)
+    remote_state = stream_handoff(remote_reader, remote_writer)
+    if local_state is None or remote_state is None:
+        return await relay_streams(local_reader, local_writer, remote_reader, remote_writer, count, proto)
+
+    done = asyncio.get_running_loop().create_future()
+    local = Relay(local_writer.transport, done, f'>>>[{count}]',
+        metrics.counter('o2pop_relay_bytes_total', proto=proto, direction='up'))
+    remote = Relay(remote_writer.transport, done, f'<<<[{count}]',
+        metrics.counter('o2pop_relay_bytes_total', proto=proto, direction='down'))
+    local.peer, remote.peer = remote, local
+    try:
+        local.start(*local_state)
+        remote.start(*remote_state)
+        timeout = args.idle_timeout
+        while not done.done():
+            if timeout <= 0:
+                await done
+                break
+            idle = time.monotonic() - max(local.last, remote.last)
+            if idle >= timeout:
+                if args.verbose:
+                    print(f'[{count}] Idle timeout ({timeout}s)')
+                # no graceful close: a peer not reading would hold it open
+                local_writer.transport.abort()
+                remote_writer.transport.abort()
+                break
+            await asyncio.wait([done], timeout=timeout - idle)
+    finally:
+        local_writer.close()
+        remote_writer.close()
+
+# relay for streams without a transport (COMPRESS=DEFLATE)
+async def relay_streams(local_reader, local_writer, remote_reader, remote_writer, count, proto):
+    remote_reader.timeout = args.idle_timeout # the server may be as quiet as the client
+    async def pump(reader, writer, label, direction):
+        nbytes = metrics.counter('o2pop_relay_bytes_total', proto=proto, direction=direction)
+        try:
+            while True:
+                data = await reader.read(args.buffer_size)
+                if not data:
+                    break
+                nbytes[0] += len(data)
+                writer.write(data)
+                await writer.drain()
+                if args.verbose:
+                    tap.put(label, data)
+        except TimeoutError:
+            if args.verbose:
+                print(f'[{count}] Idle timeout ({args.idle_timeout}s)')
+            # no graceful close, as in relay()
+            for w in (local_writer, remote_writer):
+                getattr(w, 'raw_writer', w).transport.abort() # Deflate: its connection
+            raise
+        finally:
+            writer.close()
+            if args.verbose:
+                tap.put(label, None)
+
+    await asyncio.gather(pump(local_reader, remote_writer, f'>>>[{count}]', 'up'),
+        pump(remote_reader, local_writer, f'<<<[{count}]', 'down'), return_exceptions=True)
+
+# COMPRESS=DEFLATE (RFC 4978) over reader / writer: .reader gives the inflated
+# data and write() / drain() deflate; chunks over ZLIB_INLINE go to a thread
+class Deflate:
+    def __init__(self, reader, writer):
+        self.raw_reader = reader
+        self.raw_writer = writer
+        self.compressor = zlib.compressobj(wbits=-15)
+        self.decompressor = zlib.decompressobj(wbits=-15)
+        self.pending = []
+        self.lock = asyncio.Lock()
+        self.readable = asyncio.Event()
+        self.readable.set()
+        # the inflate task reads all the time; a read of .reader waits for a reply
+        self.reader = TimedReader(getattr(reader, 'timeout', 0))
+        if isinstance(reader, TimedReader):
+            reader.timeout = 0
+        self.reader.set_transport(self) # for pause_reading / resume_reading
+        self.task = asyncio.create_task(self.inflate())
+
+    def pause_reading(self):
+        self.readable.clear()
+
+    def resume_reading(self):
+        self.readable.set()
+
+    async def run(self, func, data):
+        if len(data) <= ZLIB_INLINE:
+            return func(data)
+        return await asyncio.get_running_loop().run_in_executor(None, func, data)
+
+    async def inflate(self):
+        try:
+            while True:
+                await self.readable.wait()
+                data = await self.raw_reader.read(args.buffer_size)
+                if not data:
+                    break
+                data = await self.run(self.decompressor.decompress, data)
+                if data:
+                    self.reader.feed_data(data)
+        except (OSError, zlib.error) as ex:
+            self.reader.set_exception(ex)
+            self.raw_writer.close()
+        else:
+            self.reader.feed_eof()
+
+    def deflate(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def write(self, data):
+        self.pending.append(data)
+
+    async def drain(self):
+        async with self.lock:
+            if self.pending:
+                data = b''.join(self.pending)
+                self.pending.clear()
+                self.raw_writer.write(await self.run(self.deflate, data))
+            await self.raw_writer.drain()
+
+    def close(self):
+        if self.pending and not self.lock.locked() and not self.raw_writer.is_closing():
+            self.raw_writer.write(self.deflate(b''.join(self.pending)))
+            self.pending.clear()
+        self.raw_writer.close()
+
+    def is_closing(self):
+        return self.raw_writer.is_closing()
+
+# start COMPRESS=DEFLATE on the upstream connection; False if refused
+async def imap_compress(remote, tag):
+    s = tag + b' COMPRESS DEFLATE\r\n'
+    if args.verbose:
+        remote.print2("!>>", s)
+    remote.writer.write(s)
+    await remote.writer.drain()
+    while True:
+        s = await remote.reader.readline()
+        if args.verbose:
+            remote.print2("<<<", s)
+        if not s.startswith(b'*'):
+            break
+    if not s.startswith(tag + b' OK'):
+        return False
+    remote.deflate = Deflate(remote.reader, remote.writer)
+    remote.reader, remote.writer = remote.deflate.reader, remote.deflate
+    return True
+
+LIMIT_REPLIES = {
+    'pop': b'-ERR [SYS/TEMP] Too many connections\r\n',
+    'imap': b'* BYE [UNAVAILABLE] Too many connections\r\n',
+    'smtp': b'421 4.7.0 Too many connections, try again later\r\n',
+}
+
+async def handle_common(local_reader, local_writer, init_func, proto):
+    metrics.inc('o2pop_connections_total', proto=proto)
+    if not await session_limit.enter():
+        if args.verbose: # debug
+            print(f'Rejected: {proto}')
+        try:
+            local_writer.write(LIMIT_REPLIES[proto])
+            await local_writer.drain()
+        except OSError:
+            pass
+        local_writer.close()
+        return
+    active = metrics.gauge('o2pop_connections_active', proto=proto)
+    active[0] += 1
     try:
         step = 0
         remote = Conn()
         count = remote.count
+        remote.trace_begin(proto)
+        remote.login_deadline(local_writer.transport, args.login_timeout)
 
-        remote_writer = None
         res = await init_func(local_reader, local_writer, remote)
         remote_reader, remote_writer = remote.reader, remote.writer
         if res > 0:
             return
 
-        pipe1 = pipe(local_reader, remote_writer, 1, count)
-        pipe2 = pipe(remote_reader, local_writer, 2, count)
-
         step = 1
-        await asyncio.gather(pipe1, pipe2)
+        remote.phase('relay')
+        if remote.deflate:
+            await relay_streams(local_reader, local_writer, remote_reader, remote_writer, count, proto)
+        else:
+            await relay(local_reader, local_writer, remote_reader, remote_writer, count, proto)
 
     except Exception as ex: # debug
         if args.verbose:
@@ -109,20 +826,23 @@ async def handle_common(local_reader, local_writer, init_func):
 
     finally:
         if step == 0:
-            if remote_writer:
-                remote_writer.close()
+            if remote.writer:
+                remote.writer.close()
             local_writer.close()
         if args.verbose: # debug
-            if Conn.lock == -1:
-                print(f'[{count}] Closed')
-            elif Conn.lock == count:
-                Conn.lock = -1
+            if remote.lock:
                 print(f'[{count}] Closed - with unlock')
             else:
-                print(f'[{count}] Closed - with lock by [{Conn.lock}]')
-        else:
-            if Conn.lock == count:
-                Conn.lock = -1
+                print(f'[{count}] Closed')
+        try:
+            remote.release()
+            remote.logged_in()
+            remote.trace_end()
+        finally:
+            if remote.account is not None:
+                account_limit.leave(remote.account)
+            session_limit.leave()
+            active[0] -= 1
 
 async def pop_init(local_reader, local_writer, remote):
     verbose = args.verbose
@@ -134,6 +854,7 @@ async def pop_init(local_reader, local_writer, remote):
         print2("<<!", s)
     local_writer.write(s)
     await local_writer.drain()
+    remote.phase('client_auth')
 
     # QUIT / CAPA / USER name
     if local_reader.at_eof():
@@ -202,31 +923,61 @@ async def pop_init(local_reader, local_writer, remote):
     if verbose:
         print2(">>>", s)
 
-    while Conn.lock >= 0:
-        if verbose:
-            print(f'[{remote.count}] Locked by [{Conn.lock}]') # debug
-        await asyncio.sleep(1)
-    Conn.lock = remote.count
-
+    remote.user = user
     user_d = user.decode()
     if user_d in args.user_params:
         params = args.user_params[user_d]
     else:
         params = params_main
 
-    token = params.get_token(user_d).encode()
+    if not await account_limit.enter(user_d):
+        s = b'-ERR [SYS/TEMP] Too many connections for the account\r\n'
+        if verbose:
+            print2("<<!", s)
+        local_writer.write(s)
+        await local_writer.drain()
+        return 1
+    remote.account = user_d
+
+    await remote.acquire(params.get_token_file(user_d))
+
+    try:
+        token = (await params.get_token_async(user_d)).encode()
+    except TokenError as ex:
+        if verbose:
+            print(f'[{remote.count}] {ex}')
+        s = b'-ERR [SYS/TEMP] Failed to get auth-token\r\n'
+        if verbose:
+            print2("<<!", s)
+        local_writer.write(s)
+        await local_writer.drain()
+        return 1
+    finally:
+        remote.release()
 
     # connect to remote server
     if verbose:
         print(f'[{remote.count}] Connect to {params.remote_pop_host}:{params.remote_pop_port}')
 
-    ctx = ssl.create_default_context()
-    if args.ca_file:
-        ctx.load_verify_locations(cafile=args.ca_file)
+    ctx = get_ssl_context(params.remote_pop_host)
 
-    remote_reader, remote_writer = await asyncio.open_connection(
-        params.remote_pop_host, params.remote_pop_port, ssl=ctx)
+    remote.phase('connect')
+    t = time.monotonic()
+    try:
+        remote_reader, remote_writer = await open_upstream(
+            params.remote_pop_host, params.remote_pop_port, ctx, user_d)
+    except LimitError as ex:
+        if verbose:
+            print(f'[{remote.count}] {ex}')
+        s = b'-ERR [SYS/TEMP] Too many connections\r\n'
+        if verbose:
+            print2("<<!", s)
+        local_writer.write(s)
+        await local_writer.drain()
+        return 1
     remote.reader, remote.writer = remote_reader, remote_writer
+    metrics.observe('o2pop_upstream_connect_seconds', time.monotonic() - t, proto='pop')
+    remote.phase('upstream_auth')
  
     # <<< +OK ... ready
     if remote_reader.at_eof():
@@ -234,7 +985,9 @@ async def pop_init(local_reader, local_writer, remote):
     s = await remote_reader.readline()
     if verbose:
         print2("<<<", s)
+    save_ssl_session(ctx, remote_writer, remote.count)
 
+    login_start = time.monotonic()
     auth_string = b'user=%b\1auth=Bearer %b\1\1' % (user, token)
     auth_b64 = base64.b64encode(auth_string)
 
@@ -280,8 +1033,10 @@ async def pop_init(local_reader, local_writer, remote):
     s = await remote_reader.readline()
     if verbose:
         print2("<<<", s)
+    metrics.observe('o2pop_login_seconds', time.monotonic() - login_start, proto='pop')
     
     if not s.startswith(b'+OK'):
+        metrics.inc('o2pop_login_failures_total', proto='pop')
         s = b'QUIT\r\n'
         if verbose:
             print2("!>>", s)
@@ -302,10 +1057,630 @@ async def pop_init(local_reader, local_writer, remote):
     local_writer.write(s)
     await local_writer.drain()
 
-    Conn.lock = -1
-
+    if pop_cache or args.pop_engine:
+        return await PopSession(local_reader, local_writer, remote, user).run()
     return 0
 
+# RETR responses (dot-stuffed, with the last '.\r\n') by account and UIDL
+# blobs are named by their sha256 (checked when served) and evicted by mtime
+# when the total is over --pop_cache bytes
+class PopCache:
+    def __init__(self, path, limit):
+        self.path = path
+        self.limit = limit
+        self.index = {} # 'user uidl' -> sha256
+        self.blobs = {} # sha256 -> [size, mtime]
+        self.total = 0
+        self.checked = set() # blobs whose sha256 has been verified since load
+        self.stale = set() # dropped blobs still open elsewhere (Windows), removed later
+        self.saving = None # Future of the index write in progress
+        self.dirty = False # the index changed while it was being written
+
+    def load(self):
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            with open(os.path.join(self.path, 'index.json'), 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+            elif len(name) == 64:
+                st = os.stat(path)
+                self.blobs[name] = [st.st_size, st.st_mtime]
+                self.total += st.st_size
+        self.index = {k: v for k, v in index.items() if v in self.blobs}
+        self.evict()
+
+    # write index.json in a thread, one write at a time
+    def save_index(self):
+        if self.saving:
+            self.dirty = True
+            return
+        self.dirty = False
+        loop = asyncio.get_running_loop()
+        self.saving = loop.run_in_executor(None, self.write_index, dict(self.index))
+        self.saving.add_done_callback(self.index_saved)
+
+    def write_index(self, index):
+        path = os.path.join(self.path, 'index.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(path + '.tmp', path)
+
+    def index_saved(self, fut):
+        self.saving = None
+        if not fut.cancelled() and fut.exception() and args.verbose: # debug
+            print(f'pop cache: {fut.exception()}')
+        if self.dirty:
+            self.save_index()
+
+    def key(self, user, uidl):
+        return (user + b' ' + uidl).decode(errors='replace')
+
+    # mmap of the response, None if not cached or broken; sha256 is checked
+    # on the first open after load, the size on every open
+    async def open(self, user, uidl):
+        sha = self.index.get(self.key(user, uidl))
+        if not sha:
+            return None
+        path = os.path.join(self.path, sha)
+        try:
+            with open(path, 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.drop(sha)
+            return None
+        broken = len(m) != self.blobs[sha][0]
+        if not broken and sha not in self.checked:
+            loop = asyncio.get_running_loop()
+            h = await loop.run_in_executor(None, hashlib.sha256, m)
+            broken = h.hexdigest() != sha
+            if sha not in self.blobs: # dropped meanwhile
+                m.close()
+                return None
+            self.checked.add(sha)
+        if broken:
+            if args.verbose: # debug
+                print(f'pop cache: broken {sha}')
+            m.close()
+            self.drop(sha)
+            return None
+        now = time.time()
+        os.utime(path, (now, now))
+        self.blobs[sha][1] = now
+        return m
+
+    def drop(self, sha, save=True):
+        self.remove(sha)
+        blob = self.blobs.pop(sha, None)
+        if blob:
+            self.total -= blob[0]
+        self.checked.discard(sha)
+        if save:
+            self.index = {k: v for k, v in self.index.items() if v != sha}
+            self.save_index()
+
+    def remove(self, sha):
+        try:
+            os.remove(os.path.join(self.path, sha))
+        except FileNotFoundError:
+            pass
+        except PermissionError: # mapped by a session (Windows)
+            self.stale.add(sha)
+            return
+        self.stale.discard(sha)
+
+    # a temporary file for a response being received
+    def create(self):
+        return tempfile.NamedTemporaryFile(dir=self.path, suffix='.tmp', delete=False)
+
+    def add(self, user, uidl, tmp_path, sha, size):
+        if sha in self.blobs:
+            os.remove(tmp_path)
+        else:
+            try:
+                os.replace(tmp_path, os.path.join(self.path, sha))
+            except PermissionError: # a stale copy is still open (Windows)
+                os.remove(tmp_path)
+                return
+            self.stale.discard(sha)
+            self.blobs[sha] = [size, time.time()]
+            self.total += size
+            self.checked.add(sha) # hashed while received
+        self.index[self.key(user, uidl)] = sha
+        self.evict()
+        self.save_index()
+
+    # drop the least recently used blobs over the limit (the caller saves
+    # the index); retry removing stale ones
+    def evict(self):
+        for sha in list(self.stale):
+            self.remove(sha)
+        if self.total <= self.limit:
+            return
+        dropped = set()
+        for sha in sorted(self.blobs, key=lambda t: self.blobs[t][1]):
+            if self.total <= self.limit:
+                break
+            self.drop(sha, False)
+            dropped.add(sha)
+        self.index = {k: v for k, v in self.index.items() if v not in dropped}
+
+pop_cache = None
+
+# end of the TOP response in a cached RETR response m: header and n lines
+def pop_top_end(m, n):
+    size = len(m) - 3 # '.\r\n'
+    if m[:2] == b'\r\n':
+        i = 2
+    else:
+        i = m.find(b'\r\n\r\n', 0, size)
+        if i < 0:
+            return len(m)
+        i += 4
+    for _ in range(n):
+        j = m.find(b'\r\n', i, size)
+        if j < 0:
+            return len(m)
+        i = j + 2
+    return i
+
+# per-command latency of all pop sessions: command -> [count, total sec, max sec]
+pop_stats = {}
+
+def pop_stat(stats, cmd, t):
+    for d in (stats, pop_stats):
+        st = d.setdefault(cmd, [0, 0.0, 0.0])
+        st[0] += 1
+        st[1] += t
+        st[2] = max(st[2], t)
+
+# a client command and where its response comes from
+class PopCommand:
+    def __init__(self, s):
+        self.line = s
+        t = s.split()
+        self.cmd = t[0].lower() if t else b''
+        self.arg = t[1] if len(t) >= 2 else b''
+        self.lines = int(t[2]) if len(t) >= 3 and t[2].isdigit() else 0 # TOP
+        self.uidl = None
+        self.cached = None # mmap of the cached RETR response
+        self.prefetched = None # (status, spool) of a prefetched RETR
+        self.start = time.monotonic()
+
+    def multiline(self):
+        return self.cmd in (b'retr', b'top', b'capa') or (self.cmd in (b'list', b'uidl') and not self.arg)
+
+    def upstream(self):
+        return not (self.cached or self.prefetched)
+
+# POP commands after login, with RETR / TOP served from pop_cache and, with
+# --pop_engine, client commands pipelined upstream (PIPELINING) and the next
+# message prefetched while the client is reading the current one (after two
+# sequential RETRs, if LIST gave a size under POP_PREFETCH_SIZE)
+class PopSession:
+    def __init__(self, local_reader, local_writer, remote, user):
+        self.local_reader = local_reader
+        self.local_writer = local_writer
+        self.remote = remote
+        self.user = user
+        self.label = args.verbose and f'<<<[{remote.count}]'
+        self.uidls = {} # message number -> UIDL
+        self.last = 0 # number of messages, 0 if unknown
+        self.deleted = set()
+        self.sizes = {} # message number -> size by LIST
+        self.pipelining = False
+        self.prefetch = None # (message number, task)
+        self.abandoned = False # the prefetch is read to the end and thrown away
+        self.retr = (0, 0) # (last RETR, number of sequential RETRs)
+        self.inbuf = bytearray() # client input not yet dispatched
+        self.eof = False
+        self.hits = 0
+        self.stats = {} # command -> [count, total sec, max sec]
+        # the client traffic, as relay() counts it
+        self.bytes_up = metrics.counter('o2pop_relay_bytes_total', proto='pop', direction='up')
+        self.bytes_down = metrics.counter('o2pop_relay_bytes_total', proto='pop', direction='down')
+
+    async def run(self):
+        self.remote.phase('session')
+        try:
+            if args.pop_engine:
+                await self.capa()
+            while True:
+                batch = await self.read_batch()
+                if not batch or not await self.dispatch(batch):
+                    return 1
+        finally:
+            self.drop_prefetch()
+            if args.verbose: # debug
+                for cmd, st in self.stats.items():
+                    print(f'[{self.remote.count}] {cmd}: {st[0]} in {st[1] / st[0] * 1000:.1f} ms avg, {st[2] * 1000:.1f} ms max')
+                if self.hits:
+                    print(f'[{self.remote.count}] Prefetched: {self.hits}')
+
+    # to the client
+    def write(self, s):
+        self.bytes_down[0] += len(s)
+        self.local_writer.write(s)
+
+    def send(self, cmds):
+        s = b''.join(c.line for c in cmds)
+        if args.verbose:
+            self.remote.print2("!>>", s)
+        self.remote.writer.write(s)
+
+    async def readline(self):
+        s = await self.remote.reader.readline()
+        if args.verbose:
+            self.remote.print2("<<<", s)
+        return s
+
+    async def capa(self):
+        c = PopCommand(b'CAPA\r\n')
+        self.send([c])
+        await timed_drain(self.remote.writer, args.server_timeout)
+        s = await self.readline()
+        if not s.startswith(b'+OK'):
+            return
+        caps = b''.join([t async for t in read_to_dot(self.remote.reader, self.label)])
+        self.pipelining = any(t.split()[:1] == [b'PIPELINING'] for t in caps.upper().split(b'\r\n'))
+
+    # the next command and, with --pop_engine, the ones pipelined after it
+    # (complete lines already received)
+    async def read_batch(self):
+        while b'\n' not in self.inbuf and not self.eof:
+            if len(self.inbuf) > POP_LINE_MAX:
+                raise ValueError('POP command line too long')
+            s = await self.local_reader.read(args.buffer_size)
+            self.bytes_up[0] += len(s)
+            self.inbuf += s
+            self.eof = not s
+        batch = []
+        while self.inbuf and len(batch) < POP_PIPELINE:
+            i = self.inbuf.find(b'\n') + 1
+            if not i and not self.eof:
+                break
+            s = bytes(self.inbuf[:i or len(self.inbuf)])
+            del self.inbuf[:len(s)]
+            if args.verbose:
+                self.remote.print2(">>>", s)
+            c = PopCommand(s)
+            batch.append(c)
+            if not args.pop_engine or c.cmd == b'quit':
+                break
+        return batch
+
+    async def dispatch(self, batch):
+        for c in batch:
+            if c.cmd == b'retr' and c.arg.isdigit():
+                n, run = self.retr
+                self.retr = (int(c.arg), run + 1 if int(c.arg) == n + 1 else 1)
+            if c.cmd == b'retr' and self.prefetch and self.prefetch[0] == c.arg:
+                c.prefetched = await self.take_prefetch()
+                if c.prefetched:
+                    self.hits += 1
+                c.uidl = self.uidls.get(c.arg)
+
+        if pop_cache:
+            query = [c for c in batch if c.cmd in (b'retr', b'top') and c.arg.isdigit() and c.upstream()
+                and c.arg not in self.uidls]
+            if query:
+                await self.settle()
+                await self.query_uidls(sorted({c.arg for c in query}))
+            for c in batch:
+                if c.cmd in (b'retr', b'top') and c.arg.isdigit() and c.upstream():
+                    c.uidl = self.uidls.get(c.arg)
+                    c.cached = c.uidl and await pop_cache.open(self.user, c.uidl)
+
+        upstream = [c for c in batch if c.upstream()]
+        if upstream:
+            # DELE keeps a sequential download going
+            await self.settle(all(c.cmd == b'dele' for c in upstream))
+        if self.pipelining and len(upstream) > 1:
+            self.send(upstream)
+            await timed_drain(self.remote.writer, args.server_timeout)
+        try:
+            for c in batch:
+                if c.cached:
+                    await self.serve_cached(c)
+                elif c.prefetched:
+                    await self.serve_prefetched(c)
+                else:
+                    if not (self.pipelining and len(upstream) > 1):
+                        self.send([c])
+                        await timed_drain(self.remote.writer, args.server_timeout)
+                    if not await self.serve(c):
+                        return False
+                pop_stat(self.stats, c.cmd.upper().decode(errors='replace'), time.monotonic() - c.start)
+        finally:
+            for c in batch:
+                if c.cached:
+                    c.cached.close()
+                if c.prefetched and c.prefetched[1]:
+                    c.prefetched[1].close()
+
+        n, run = self.retr
+        if args.pop_engine and not self.inbuf and not self.prefetch and run >= 2 and any(c.cmd == b'retr' for c in batch):
+            n += 1
+            while n <= self.last and b'%d' % n in self.deleted:
+                n += 1
+            n = b'%d' % n
+            if self.sizes.get(n, POP_PREFETCH_SIZE + 1) <= POP_PREFETCH_SIZE:
+                self.abandoned = False
+                self.prefetch = (n, asyncio.create_task(self.fetch(n)))
+        return True
+
+    async def query_uidls(self, nums):
+        cmds = [PopCommand(b'UIDL %b\r\n' % n) for n in nums]
+        if self.pipelining:
+            self.send(cmds)
+            await timed_drain(self.remote.writer, args.server_timeout)
+        for c in cmds:
+            if not self.pipelining:
+                self.send([c])
+                await timed_drain(self.remote.writer, args.server_timeout)
+            t = (await self.readline()).split()
+            if len(t) == 3 and t[0] == b'+OK':
+                self.uidls[t[1]] = t[2]
+
+    # RETR n into a spool file; None if the message is in pop_cache
+    async def fetch(self, n):
+        if pop_cache:
+            if n not in self.uidls:
+                await self.query_uidls([n])
+            uidl = self.uidls.get(n)
+            if uidl and pop_cache.key(self.user, uidl) in pop_cache.index:
+                return None
+        self.send([PopCommand(b'RETR %b\r\n' % n)])
+        await timed_drain(self.remote.writer, args.server_timeout)
+        status = await self.readline()
+        if not status.startswith(b'+OK'):
+            return (status, None)
+        spool = tempfile.SpooledTemporaryFile(max_size=args.spool_size)
+        try:
+            async for t in read_to_dot(self.remote.reader, self.label):
+                if not self.abandoned:
+                    spool.write(t)
+        except BaseException:
+            spool.close()
+            raise
+        return (status, spool)
+
+    async def take_prefetch(self):
+        n, task = self.prefetch
+        self.prefetch = None
+        return await task
+
+    # abandon the prefetch before other commands go upstream: a RETR cannot
+    # be called off once sent, so the rest of it is read and thrown away;
+    # keep: wait for it and keep the message
+    async def settle(self, keep=False):
+        if not self.prefetch:
+            return
+        n, task = self.prefetch
+        if keep:
+            await asyncio.wait([task])
+            return
+        self.prefetch = None
+        self.abandoned = True
+        r = await task
+        if r and r[1]:
+            r[1].close()
+
+    def drop_prefetch(self):
+        if not self.prefetch:
+            return
+        n, task = self.prefetch
+        self.prefetch = None
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and not task.exception():
+            r = task.result()
+            if r and r[1]:
+                r[1].close()
+
+    async def serve_cached(self, c):
+        if args.verbose: # debug
+            print(f'[{self.remote.count}] Cached {c.uidl}')
+        m = c.cached
+        end = len(m)
+        if c.cmd == b'top':
+            end = pop_top_end(m, c.lines)
+        self.write(b'+OK message follows\r\n')
+        size = args.buffer_size
+        for i in range(0, end, size):
+            self.write(m[i:min(i + size, end)])
+            await timed_drain(self.local_writer, args.idle_timeout)
+        if end < len(m):
+            self.write(b'.\r\n')
+        await timed_drain(self.local_writer, args.idle_timeout)
+
+    async def serve_prefetched(self, c):
+        status, spool = c.prefetched
+        if args.verbose: # debug
+            print(f'[{self.remote.count}] Prefetched {c.arg.decode()}')
+        self.write(status)
+        await timed_drain(self.local_writer, args.idle_timeout)
+        if spool:
+            spool.seek(0)
+            await self.body(c, spool_chunks(spool))
+
+    # relay the response from the server; False at the end of the session
+    async def serve(self, c):
+        s = await self.readline()
+        if not s:
+            return False
+        self.write(s)
+        await timed_drain(self.local_writer, args.idle_timeout)
+        if c.cmd == b'quit':
+            return False
+        if not s.startswith(b'+OK'):
+            return True
+        t = s.split()
+        if c.cmd == b'stat' and len(t) >= 2 and t[1].isdigit():
+            self.last = int(t[1])
+        elif c.cmd == b'list' and c.arg and len(t) == 3 and t[2].isdigit():
+            self.sizes[t[1]] = int(t[2])
+        elif c.cmd == b'uidl' and c.arg and len(t) == 3:
+            self.uidls[t[1]] = t[2]
+        elif c.cmd == b'dele':
+            self.deleted.add(c.arg)
+            if self.prefetch and self.prefetch[0] == c.arg:
+                self.drop_prefetch()
+        if not c.multiline():
+            return True
+
+        listing = await self.body(c, read_to_dot(self.remote.reader, self.label))
+        if c.cmd == b'capa':
+            if args.pop_engine and not any(t.split()[:1] == [b'PIPELINING'] for t in listing.upper().split(b'\r\n')):
+                listing = listing[:-3] + b'PIPELINING\r\n.\r\n'
+            self.write(listing)
+            await timed_drain(self.local_writer, args.idle_timeout)
+        elif listing:
+            nums = []
+            for t in listing.split(b'\r\n'):
+                t = t.split()
+                if len(t) == 2 and t[0].isdigit():
+                    nums.append(int(t[0]))
+                    if c.cmd == b'uidl':
+                        self.uidls[t[0]] = t[1]
+                    elif t[1].isdigit():
+                        self.sizes[t[0]] = int(t[1])
+            self.last = max(nums, default=self.last)
+        return True
+
+    # send a multi-line response from chunks to the client, keeping RETR in
+    # pop_cache; returns the response of CAPA (not sent), LIST and UIDL
+    async def body(self, c, chunks):
+        f = h = None
+        size = 0
+        if c.cmd == b'retr' and c.uidl and pop_cache:
+            f = pop_cache.create()
+            h = hashlib.sha256()
+        listing = []
+        try:
+            async for s in chunks:
+                if c.cmd in (b'capa', b'list', b'uidl'):
+                    listing.append(s)
+                if c.cmd == b'capa':
+                    continue
+                self.write(s)
+                await timed_drain(self.local_writer, args.idle_timeout)
+                if f:
+                    size += len(s)
+                    if size > pop_cache.limit:
+                        f.close()
+                        os.remove(f.name)
+                        f = None
+                    else:
+                        f.write(s)
+                        h.update(s)
+            if f:
+                f.close()
+                pop_cache.add(self.user, c.uidl, f.name, h.hexdigest(), size)
+                f = None
+        finally:
+            if f:
+                f.close()
+                os.remove(f.name)
+        return b''.join(listing)
+
+async def spool_chunks(f):
+    while True:
+        s = f.read(args.buffer_size)
+        if not s:
+            break
+        yield s
+
+# connect and authenticate; returns the tagged reply (b'' on EOF)
+async def imap_connect(params, user, token, remote, tag):
+    verbose = args.verbose
+    print2 = remote.print2
+
+    # connect to remote server
+    if verbose:
+        print(f'[{remote.count}] Connect to {params.remote_imap_host}:{params.remote_imap_port}')
+
+    ctx = get_ssl_context(params.remote_imap_host)
+
+    remote.phase('connect')
+    t = time.monotonic()
+    remote_reader, remote_writer = await open_upstream(
+        params.remote_imap_host, params.remote_imap_port, ctx, user.decode())
+    remote.reader, remote.writer = remote_reader, remote_writer
+    metrics.observe('o2pop_upstream_connect_seconds', time.monotonic() - t, proto='imap')
+    remote.phase('upstream_auth')
+ 
+    # <<< * OK ... ready
+    if remote_reader.at_eof():
+        return b''
+    s = await remote_reader.readline()
+    if verbose:
+        print2("<<<", s)
+    save_ssl_session(ctx, remote_writer, remote.count)
+
+    login_start = time.monotonic()
+    auth_string = b'user=%b\1auth=Bearer %b\1\1' % (user, token)
+    auth_b64 = base64.b64encode(auth_string)
+    s = tag + b' AUTHENTICATE XOAUTH2 %b\r\n' % auth_b64
+
+    if verbose:
+        if args.verbose == 1:
+            blen = '*{' + str(len(auth_b64)) + '}'
+            t = tag + b' AUTHENTICATE XOAUTH2 %b\r\n' % blen.encode()
+            print2("!>>", t)
+        else:
+            print2("!>>", s)
+
+    remote_writer.write(s)
+    await remote_writer.drain()
+
+    # OK: <<< tag OK Success / tag OK AUTHENTICATE Completed.
+    # NG: <<< + eyJzdGF0d... / tag NO AUTHENTICATE failed.
+    while True:
+        if remote_reader.at_eof():
+            return b''
+        s = await remote_reader.readline()
+        if verbose:
+            print2("<<<", s)
+        if not s.startswith(b'*'):
+            break
+    
+    if s.startswith(b'+'):
+        s = b'\r\n'
+        if verbose:
+            print2("!>>", s)
+        remote_writer.write(s)
+        await remote_writer.drain()
+        if remote_reader.at_eof():
+            return b''
+        s = await remote_reader.readline()
+        if verbose:
+            print2("<<<", s)
+
+    metrics.observe('o2pop_login_seconds', time.monotonic() - login_start, proto='imap')
+    if not s.startswith(tag + b' OK'):
+        metrics.inc('o2pop_login_failures_total', proto='imap')
+        t = b'99 LOGOUT\r\n'
+        if verbose:
+            print2("!>>", t)
+        remote_writer.write(t)
+        await remote_writer.drain()
+        while True:
+            if remote_reader.at_eof():
+                break
+            t = await remote_reader.readline()
+            if verbose:
+                print2("<<<", t)
+            if not t.startswith(b'*'):
+                break
+    elif args.imap_compress:
+        await imap_compress(remote, tag + b'Z')
+    return s
+
 async def imap_init(local_reader, local_writer, remote):
     verbose = args.verbose
     print2 = remote.print2
@@ -316,6 +1691,7 @@ async def imap_init(local_reader, local_writer, remote):
         print2("<<!", s)
     local_writer.write(s)
     await local_writer.drain()
+    remote.phase('client_auth')
 
     # LOGOUT / CAPABILITY / LOGIN
     if local_reader.at_eof():
@@ -398,115 +1774,79 @@ async def imap_init(local_reader, local_writer, remote):
         await local_writer.drain()
         return 1
 
-    while Conn.lock >= 0:
-        if verbose:
-            print(f'[{remote.count}] Locked by [{Conn.lock}]') # debug
-        await asyncio.sleep(1)
-    Conn.lock = remote.count
-
+    remote.user = user
     user_d = user.decode()
     if user_d in args.user_params:
         params = args.user_params[user_d]
     else:
         params = params_main
 
-    token = params.get_token(user_d).encode()
+    if not await account_limit.enter(user_d):
+        s = tag + b' NO [LIMIT] Too many connections for the account\r\n'
+        if verbose:
+            print2("<<!", s)
+        local_writer.write(s)
+        await local_writer.drain()
+        return 1
+    remote.account = user_d
 
-    # connect to remote server
-    if verbose:
-        print(f'[{remote.count}] Connect to {params.remote_imap_host}:{params.remote_imap_port}')
+    if imap_pool: # multiplexing
+        return await imap_mux(local_reader, local_writer, remote, params, user, tag)
 
-    ctx = ssl.create_default_context()
-    if args.ca_file:
-        ctx.load_verify_locations(cafile=args.ca_file)
+    await remote.acquire(params.get_token_file(user_d))
 
-    remote_reader, remote_writer = await asyncio.open_connection(
-        params.remote_imap_host, params.remote_imap_port, ssl=ctx)
-    remote.reader, remote.writer = remote_reader, remote_writer
- 
-    # <<< * OK ... ready
-    if remote_reader.at_eof():
+    try:
+        token = (await params.get_token_async(user_d)).encode()
+    except TokenError as ex:
+        if verbose:
+            print(f'[{remote.count}] {ex}')
+        s = tag + b' NO [UNAVAILABLE] Failed to get auth-token\r\n'
+        if verbose:
+            print2("<<!", s)
+        local_writer.write(s)
+        await local_writer.drain()
         return 1
-    s = await remote_reader.readline()
-    if verbose:
-        print2("<<<", s)
+    finally:
+        remote.release()
 
-    auth_string = b'user=%b\1auth=Bearer %b\1\1' % (user, token)
-    auth_b64 = base64.b64encode(auth_string)
-    s = tag + b' AUTHENTICATE XOAUTH2 %b\r\n' % auth_b64
+    try:
+        s = await imap_connect(params, user, token, remote, tag)
+    except LimitError as ex:
+        if verbose:
+            print(f'[{remote.count}] {ex}')
+        s = tag + b' NO [LIMIT] Too many connections\r\n'
+        if verbose:
+            print2("<<!", s)
+        local_writer.write(s)
+        await local_writer.drain()
+        return 1
+    if not s:
+        return 1
+    if not s.startswith(tag + b' OK'):
+        s = tag + b' NO LOGIN failed\r\n'
+        if verbose:
+            print2("<<!", s)
+        local_writer.write(s)
+        await local_writer.drain()
+        return 1
+    remote_reader, remote_writer = remote.reader, remote.writer
 
-    if verbose:
-        if args.verbose == 1:
-            blen = '*{' + str(len(auth_b64)) + '}'
-            t = tag + b' AUTHENTICATE XOAUTH2 %b\r\n' % blen.encode()
-            print2("!>>", t)
-        else:
-            print2("!>>", s)
-
-    remote_writer.write(s)
-    await remote_writer.drain()
-
-    # OK: <<< tag OK Success / tag OK AUTHENTICATE Completed.
-    # NG: <<< + eyJzdGF0d... / tag NO AUTHENTICATE failed.
-    while True:
-        if remote_reader.at_eof():
-            return 1
-        s = await remote_reader.readline()
-        if verbose:
-            print2("<<<", s)
-        if not s.startswith(b'*'):
-            break
-    
-    if s.startswith(b'+'):
-        s = b'\r\n'
-        if verbose:
-            print2("!>>", s)
-        remote_writer.write(s)
-        await remote_writer.drain()
-        if remote_reader.at_eof():
-            return 1
-        s = await remote_reader.readline()
-        if verbose:
-            print2("<<<", s)
-
-    if not s.startswith(tag + b' OK'):
-        s = b'99 LOGOUT\r\n'
-        if verbose:
-            print2("!>>", s)
-        remote_writer.write(s)
-        await remote_writer.drain()
-        while True:
-            if remote_reader.at_eof():
-                return 1
-            s = await remote_reader.readline()
-            if verbose:
-                print2("<<<", s)
-            if not s.startswith(b'*'):
-                break
-
-        s = tag + b' NO LOGIN failed\r\n'
-        if verbose:
-            print2("<<!", s)
-        local_writer.write(s)
-        await local_writer.drain()
-        return 1
-
-    s = tag + b' OK LOGIN completed\r\n'
+    s = tag + b' OK LOGIN completed\r\n'
     if verbose:
         print2("<<!", s)
     local_writer.write(s)
     await local_writer.drain()
 
-    Conn.lock = -1
-
-    # CAPABILITY after Auth
-    if not verbose:
+    # CAPABILITY after Auth: COMPRESS=DEFLATE is not offered to the client
+    # when the proxy reads the stream
+    if not verbose and not remote.deflate:
         return 0
 
     if local_reader.at_eof():
         return 1
     s = await local_reader.readline()
-    print2(">>>", s)
+    if verbose:
+        print2(">>>", s)
 
     remote_writer.write(s)
     await remote_writer.drain()
@@ -521,11 +1861,13 @@ async def imap_init(local_reader, local_writer, remote):
         if remote_reader.at_eof():
             return 1
         s = await remote_reader.readline()
-        print2("<<<", s)
+        if verbose:
+            print2("<<<", s)
         if s.startswith(b'*') and cmd == b'capability':
             t = s
             s = t.replace(b' COMPRESS=DEFLATE', b'', 1)
-            print2("<<!", s)
+            if verbose:
+                print2("<<!", s)
         local_writer.write(s)
         await local_writer.drain()
         if not s.startswith(b'*'):
@@ -533,6 +1875,498 @@ async def imap_init(local_reader, local_writer, remote):
 
     return 0
 
+# literal at the end of an IMAP line: (size, synchronizing), size -1 if none
+def imap_literal(s):
+    s = s.rstrip(b'\r\n')
+    if not s.endswith(b'}'):
+        return -1, False
+    i = s.rfind(b'{')
+    if i < 0:
+        return -1, False
+    t = s[i + 1:-1]
+    sync = not t.endswith(b'+')
+    if not sync:
+        t = t[:-1]
+    if not t.isdigit():
+        return -1, False
+    return int(t), sync
+
+# a command with its literals: [line, literal, line, ...]; None on EOF
+async def imap_read_command(local_reader, local_writer, remote):
+    verbose = args.verbose
+    parts = []
+    while True:
+        if local_reader.at_eof():
+            return None
+        s = await local_reader.readline()
+        if not s:
+            return None
+        if verbose:
+            remote.print2(">>>", s)
+        parts.append(s)
+        n, sync = imap_literal(s)
+        if n < 0:
+            return parts
+        if sync:
+            s = b'+ Ready for literal data\r\n'
+            if verbose:
+                remote.print2("<<!", s)
+            local_writer.write(s)
+            await local_writer.drain()
+        try:
+            s = await local_reader.readexactly(n)
+        except asyncio.IncompleteReadError:
+            return None
+        if verbose:
+            tap.put(f'>>>[{remote.count}]', s)
+            tap.put(f'>>>[{remote.count}]', None)
+        parts.append(s)
+
+# readline() past the limit of the reader (e.g. SEARCH on a large mailbox)
+async def readline_long(reader):
+    chunks = []
+    while True:
+        try:
+            chunks.append(await reader.readuntil(b'\n'))
+            break
+        except asyncio.IncompleteReadError as ex:
+            chunks.append(ex.partial)
+            break
+        except asyncio.LimitOverrunError as ex:
+            chunks.append(await reader.readexactly(ex.consumed))
+    return b''.join(chunks)
+
+# a local client of the multiplexer
+class ImapClient:
+    def __init__(self, remote, local_writer):
+        self.remote = remote
+        self.writer = local_writer
+        self.mailbox = None # SELECT / EXAMINE command (parts without the tag)
+        self.exists = 0 # the last EXISTS sent
+
+# an authenticated upstream connection shared by local clients
+class ImapUpstream:
+    def __init__(self, key):
+        self.key = key
+        self.remote = Conn()
+        self.mailbox = None
+        self.exists = 0
+        self.busy = True
+        self.tag_count = 0
+        self.used = time.monotonic()
+
+    def next_tag(self):
+        self.tag_count += 1
+        return b'M%d' % self.tag_count
+
+    def close(self):
+        if self.remote.writer:
+            self.remote.writer.close()
+
+    # send a command (parts; the first line without the tag) and copy untagged
+    # responses to client (None: discard) or lines; the tagged reply is copied
+    # with client_tag, if given; returns the tagged reply, b'' on EOF
+    async def command(self, parts, client=None, client_tag=None, lines=None):
+        verbose = args.verbose
+        remote = self.remote
+        writer = remote.writer
+        tag = self.next_tag()
+        self.used = time.monotonic()
+        for i, s in enumerate(parts):
+            if i % 2: # literal
+                if verbose:
+                    tap.put(f'!>>[{remote.count}]', s)
+                    tap.put(f'!>>[{remote.count}]', None)
+                writer.write(s)
+                continue
+            if i == 0:
+                s = tag + b' ' + s
+            if verbose:
+                remote.print2("!>>", s)
+            writer.write(s)
+            n, sync = imap_literal(s)
+            if n >= 0 and sync:
+                await timed_drain(writer, args.server_timeout)
+                s = await self.response(tag, client, client_tag, lines, True)
+                if not s.startswith(b'+'):
+                    return s
+        await timed_drain(writer, args.server_timeout)
+        return await self.response(tag, client, client_tag, lines)
+
+    async def response(self, tag, client, client_tag, lines, cont=False):
+        verbose = args.verbose
+        remote = self.remote
+        reader = remote.reader
+        local_writer = client and client.writer
+        while True:
+            s = await readline_long(reader)
+            if not s:
+                return b''
+            if verbose:
+                remote.print2("<<<", s)
+            if cont and s.startswith(b'+'):
+                return s
+            if s.startswith(tag + b' '):
+                if client_tag is not None:
+                    s = client_tag + s[len(tag):]
+                    if verbose:
+                        client.remote.print2("<<!", s)
+                    local_writer.write(s)
+                    await timed_drain(local_writer, args.idle_timeout)
+                return s
+
+            t = s.split(maxsplit=3)
+            if len(t) >= 3 and t[1].isdigit() and t[2].upper() == b'EXISTS':
+                self.exists = int(t[1])
+                if client:
+                    client.exists = self.exists
+            while True:
+                if local_writer:
+                    local_writer.write(s)
+                elif lines is not None:
+                    lines.append(s)
+                n, _ = imap_literal(s)
+                if n < 0:
+                    break
+                while n > 0:
+                    t = await reader.read(min(n, args.buffer_size))
+                    if not t:
+                        return b''
+                    n -= len(t)
+                    if verbose:
+                        tap.put(f'<<<[{remote.count}]', t)
+                    if local_writer:
+                        local_writer.write(t)
+                        await timed_drain(local_writer, args.idle_timeout)
+                if verbose:
+                    tap.put(f'<<<[{remote.count}]', None)
+                s = await readline_long(reader)
+                if not s:
+                    return b''
+                if verbose:
+                    remote.print2("<<<", s)
+            if local_writer:
+                await timed_drain(local_writer, args.idle_timeout)
+
+    # select the mailbox of the client (responses are not sent to the client)
+    async def switch(self, mailbox):
+        if mailbox is None or mailbox == self.mailbox:
+            return True
+        self.mailbox = None
+        s = await self.command(mailbox)
+        if not s:
+            return False
+        t = s.split(maxsplit=2)
+        if len(t) >= 2 and t[1] == b'OK':
+            self.mailbox = mailbox
+            return True
+        return False
+
+# upstream connections of --imap_mux per account
+class ImapPool:
+    def __init__(self):
+        self.conns = {} # token file -> [ImapUpstream, ...]
+        self.waiters = {} # token file -> [Future, ...]
+
+    # a connection in mailbox if any is free, else another one (None on error
+    # or when none is free within --queue_timeout)
+    async def lease(self, key, mailbox, params, user):
+        deadline = time.monotonic() + args.queue_timeout
+        while True:
+            conns = self.conns.setdefault(key, [])
+            free = [t for t in conns if not t.busy]
+            for up in free:
+                if up.mailbox == mailbox:
+                    break
+            else:
+                up = free[0] if free else None
+            if up:
+                up.busy = True
+                return up
+
+            if len(conns) < args.imap_mux:
+                up = ImapUpstream(key)
+                conns.append(up) # reserve the slot while connecting
+                if await self.connect(up, params, user):
+                    return up
+                self.release(up, False)
+                return None
+
+            waiter = asyncio.get_running_loop().create_future()
+            waiters = self.waiters.setdefault(key, [])
+            waiters.append(waiter)
+            t = time.monotonic()
+            try:
+                await asyncio.wait([waiter], timeout=max(deadline - t, 0))
+                if not waiter.done():
+                    waiter.cancel()
+                    metrics.inc('o2pop_rejected_total', limit='imap_mux')
+                    return None
+            except asyncio.CancelledError:
+                # a release() meant for this waiter goes to the next one
+                if waiter.done() and not waiter.cancelled():
+                    self.wake(key)
+                raise
+            finally:
+                metrics.observe('o2pop_queue_wait_seconds', time.monotonic() - t, queue='imap_mux')
+                if waiter in waiters:
+                    waiters.remove(waiter)
+
+    async def connect(self, up, params, user):
+        remote = up.remote
+        await remote.acquire(up.key)
+        try:
+            token = (await params.get_token_async(user.decode())).encode()
+            remote.release()
+            tag = up.next_tag()
+            s = await imap_connect(params, user, token, remote, tag)
+            return s.startswith(tag + b' OK')
+        except (TokenError, LimitError, OSError, asyncio.IncompleteReadError) as ex:
+            if args.verbose:
+                print(f'[{remote.count}] {ex}')
+            return False
+        finally:
+            remote.release()
+
+    # ok: False closes the connection
+    def release(self, up, ok=True):
+        up.busy = False
+        if not ok:
+            up.close()
+            conns = self.conns.get(up.key, [])
+            if up in conns:
+                conns.remove(up)
+        self.wake(up.key)
+
+    def wake(self, key):
+        for waiter in self.waiters.get(key, []):
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    async def keepalive(self):
+        try:
+            while True:
+                await asyncio.sleep(IMAP_NOOP_INTERVAL / 4)
+                now = time.monotonic()
+                for conns in list(self.conns.values()):
+                    for up in list(conns):
+                        if up.busy or now - up.used < IMAP_NOOP_INTERVAL:
+                            continue
+                        up.busy = True
+                        ok = False
+                        try:
+                            ok = bool(await up.command([b'NOOP\r\n']))
+                        except (OSError, asyncio.IncompleteReadError):
+                            pass
+                        finally:
+                            self.release(up, ok)
+        finally:
+            for conns in self.conns.values():
+                for up in conns:
+                    up.close()
+            self.conns.clear()
+
+imap_pool = None
+
+IMAP_SELECTED_COMMANDS = (b'check', b'close', b'expunge', b'search', b'fetch', b'store',
+    b'copy', b'move', b'uid', b'unselect')
+# refused: message sequence numbers differ among the clients sharing a mailbox
+# (an EXPUNGE is seen only by the client whose command got it); UID ones are fine
+IMAP_SEQUENCE_COMMANDS = (b'search', b'fetch', b'store', b'copy', b'move', b'sort', b'thread')
+# not offered to the local clients: connection state that would be shared
+IMAP_HIDDEN_CAPS = (b'COMPRESS=', b'ENABLE', b'UTF8=', b'QRESYNC', b'NOTIFY', b'LOGINDISABLED',
+    b'AUTH=', b'STARTTLS')
+
+# local IMAP session over shared upstream connections (--imap_mux)
+async def imap_mux(local_reader, local_writer, remote, params, user, tag):
+    verbose = args.verbose
+    print2 = remote.print2
+    key = params.get_token_file(user.decode())
+    client = ImapClient(remote, local_writer)
+
+    remote.phase('lease')
+    up = await imap_pool.lease(key, None, params, user)
+    if up:
+        imap_pool.release(up)
+        s = tag + b' OK LOGIN completed\r\n'
+    else:
+        s = tag + b' NO LOGIN failed\r\n'
+    if verbose:
+        print2("<<!", s)
+    local_writer.write(s)
+    await timed_drain(local_writer, args.idle_timeout)
+    if not up:
+        return 1
+    remote.phase('session')
+
+    while True:
+        parts = await imap_read_command(local_reader, local_writer, remote)
+        if not parts:
+            return 1
+        t = parts[0].split(maxsplit=2)
+        if len(t) < 2:
+            s = b'* BAD malformed command\r\n'
+            if verbose:
+                print2("<<!", s)
+            local_writer.write(s)
+            await timed_drain(local_writer, args.idle_timeout)
+            continue
+        tag = t[0]
+        cmd = t[1].lower()
+        parts[0] = parts[0][len(tag):].lstrip(b' ')
+
+        s = b''
+        if cmd == b'logout':
+            s = b'* BYE LOGOUT Requested\r\n' + tag + b' OK Completed\r\n'
+        elif cmd == b'idle':
+            if not await imap_mux_idle(local_reader, client, tag, params, user, key):
+                return 1
+            continue
+        elif cmd == b'login' or cmd == b'authenticate' or cmd == b'starttls':
+            s = tag + b' BAD Already authenticated\r\n'
+        elif cmd == b'compress':
+            s = tag + b' NO Not supported\r\n'
+        elif cmd == b'enable':
+            s = b'* ENABLED\r\n' + tag + b' OK Completed\r\n'
+        elif cmd in IMAP_SELECTED_COMMANDS and client.mailbox is None:
+            s = tag + b' BAD No mailbox selected\r\n'
+        elif cmd in IMAP_SEQUENCE_COMMANDS:
+            s = tag + b' NO [CANNOT] Use UID ' + cmd.upper() + b' (sequence numbers are not shared)\r\n'
+        if s:
+            if verbose:
+                print2("<<!", s)
+            local_writer.write(s)
+            await timed_drain(local_writer, args.idle_timeout)
+            if cmd == b'logout':
+                return 1
+            continue
+
+        select = cmd == b'select' or cmd == b'examine'
+        mailbox = parts if select else client.mailbox
+        up = await imap_pool.lease(key, mailbox, params, user)
+        s = b''
+        try:
+            if not up or not (select or await up.switch(mailbox)):
+                pass
+            elif cmd == b'capability':
+                s = await imap_mux_capability(up, client, tag)
+            else:
+                if select:
+                    up.mailbox = client.mailbox = None
+                s = await up.command(parts, client, tag)
+        except (OSError, asyncio.IncompleteReadError) as ex:
+            if verbose:
+                print(f'[{remote.count}] {ex}')
+        finally:
+            # any other error also discards the connection: its state is unknown
+            if up:
+                imap_pool.release(up, bool(s))
+        if not s:
+            s = tag + b' NO [UNAVAILABLE] Server connection failed\r\n'
+            if verbose:
+                print2("<<!", s)
+            local_writer.write(s)
+            await timed_drain(local_writer, args.idle_timeout)
+            continue
+
+        t = s.split(maxsplit=2)
+        ok = len(t) >= 2 and t[1] == b'OK'
+        if select and ok:
+            up.mailbox = client.mailbox = parts
+        elif cmd == b'close' or cmd == b'unselect':
+            if ok:
+                up.mailbox = client.mailbox = None
+        elif client.mailbox and up.mailbox == client.mailbox and up.exists > client.exists:
+            # new mails seen by another client on this connection
+            client.exists = up.exists
+            s = b'* %d EXISTS\r\n' % up.exists
+            if verbose:
+                print2("<<!", s)
+            local_writer.write(s)
+            await timed_drain(local_writer, args.idle_timeout)
+
+async def imap_mux_capability(up, client, tag):
+    lines = []
+    s = await up.command([b'CAPABILITY\r\n'], None, None, lines)
+    if not s:
+        return s
+    for t in lines:
+        if t.upper().startswith(b'* CAPABILITY '):
+            caps = [c for c in t.split()[2:] if not c.upper().startswith(IMAP_HIDDEN_CAPS)]
+            t = b'* CAPABILITY ' + b' '.join(caps) + b'\r\n'
+            client.writer.write(t)
+    s = tag + b' ' + s.split(b' ', 1)[1]
+    if args.verbose:
+        client.remote.print2("<<!", s)
+    client.writer.write(s)
+    await timed_drain(client.writer, args.idle_timeout)
+    return s
+
+# IDLE is emulated: NOOP on a connection in the mailbox every --imap_idle_poll
+# seconds until DONE; returns False on EOF
+async def imap_mux_idle(local_reader, client, tag, params, user, key):
+    verbose = args.verbose
+    print2 = client.remote.print2
+    local_writer = client.writer
+
+    s = b'+ idling\r\n'
+    if verbose:
+        print2("<<!", s)
+    local_writer.write(s)
+    await timed_drain(local_writer, args.idle_timeout)
+
+    # one readline() for the whole IDLE; polls while it waits
+    read = asyncio.ensure_future(local_reader.readline())
+    try:
+        s = await imap_mux_poll(read, client, params, user, key)
+    finally:
+        read.cancel()
+
+    if not s:
+        return False
+    if verbose:
+        print2(">>>", s)
+    if s.strip().upper() == b'DONE':
+        s = tag + b' OK IDLE terminated\r\n'
+    else:
+        s = tag + b' BAD Expected DONE\r\n'
+    if verbose:
+        print2("<<!", s)
+    local_writer.write(s)
+    await timed_drain(local_writer, args.idle_timeout)
+    return True
+
+# NOOP every --imap_idle_poll seconds until read is done; its line
+async def imap_mux_poll(read, client, params, user, key):
+    verbose = args.verbose
+    print2 = client.remote.print2
+    local_writer = client.writer
+    while True:
+        await asyncio.wait([read], timeout=args.imap_idle_poll)
+        if read.done():
+            return read.result()
+        if client.mailbox is None:
+            continue
+        up = await imap_pool.lease(key, client.mailbox, params, user)
+        if not up:
+            continue
+        ok = False
+        try:
+            if await up.switch(client.mailbox):
+                ok = bool(await up.command([b'NOOP\r\n'], client))
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            imap_pool.release(up, ok)
+        if ok and up.exists > client.exists:
+            client.exists = up.exists
+            s = b'* %d EXISTS\r\n' % up.exists
+            if verbose:
+                print2("<<!", s)
+            local_writer.write(s)
+            await timed_drain(local_writer, args.idle_timeout)
+
 def get_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
@@ -544,62 +2378,811 @@ def get_ip():
         s.close()
     return ip
 
-def to_cc_count(data, exclude=None):
-    found = False
-    h = []
-    for s in data:
-        if s == b'\r\n':
-            break
-        t = s.lower()
-        if t.startswith(b'to:') or t.startswith(b'cc:'):
-            found = True
-        elif found:
-            t0 = t[:1]
-            if t0 != b' ' and t0 != b'\t':
-                found = False    
-        if found:
-            h.append(t)
-
-    t = b''.join(h).translate(bytes.maketrans(b',<>\r\n', b'     '))
-    emails = []
-    for s in t.split():
-        if (b'@' in s) and (not b'"' in s) and (not b'\\' in s):
-            emails.append(s)
-
-    if exclude:
-        for t in exclude.replace(b',', b' ').lower().split():
-            r = []
+# list of email addresses and domains (e.g. block list)
+# 'user@example.com' matches the address, others ('@example.com', 'example.com',
+# '.example.com') match as a suffix; suffixes are grouped by length so a lookup
+# costs one hash per distinct length instead of one comparison per entry
+class AddressMatcher:
+    def __init__(self, text):
+        self.text = text
+        self.emails = set()
+        self.suffixes = {} # length -> set of suffixes
+        for t in text.translate(bytes.maketrans(b',\r\n', b'   ')).lower().split():
             if t.find(b'@') > 0 and (not t.startswith(b'.')):
-                for s in emails:
-                    if s != t:
-                        r.append(s)
+                self.emails.add(t)
             else:
-                for s in emails:
-                    if not s.endswith(t):
-                        r.append(s)
-            emails = r
-    return len(emails)
-
-def remove_agent_header(data):
-    i = 0
-    found = False
-    index = []
-    for s in data:
+                self.suffixes.setdefault(len(t), set()).add(t)
+        self.lengths = sorted(self.suffixes)
+
+    def __bool__(self):
+        return bool(self.emails or self.suffixes)
+
+    # email: lower case
+    def match(self, email):
+        if email in self.emails:
+            return True
+        n = len(email)
+        for i in self.lengths:
+            if i > n:
+                break
+            if email[n - i:] in self.suffixes[i]:
+                return True
+        return False
+
+# fields of a mail header (list of lines) in one pass:
+# lower-cased field name -> [(start, end), ...] line ranges of data,
+# including the folded lines of the field
+def header_index(data):
+    index = {}
+    name = None
+    start = 0
+    end = len(data)
+    for i, s in enumerate(data):
         if s == b'\r\n':
+            end = i
             break
-        t = s.lower()
-        if t.startswith(b'user-agent:') or t.startswith(b'x-mailer:'):
-            found = True
-        elif found:
-            t0 = t[:1]
-            if t0 != b' ' and t0 != b'\t':
-                found = False
-        if found:
-            index.append(i)
-        i += 1
-
-    while index:
-        data.pop(index.pop())
+        t0 = s[:1]
+        if t0 == b' ' or t0 == b'\t': # folded
+            continue
+        if name is not None:
+            index.setdefault(name, []).append((start, i))
+        name = s.split(b':', 1)[0].lower()
+        start = i
+    if name is not None:
+        index.setdefault(name, []).append((start, end))
+    return index
+
+TO_CC_SEPARATORS = bytes.maketrans(b',<>\r\n', b'     ')
+
+# number of addresses in To: and Cc:; exclude: AddressMatcher
+def to_cc_count(data, exclude=None, index=None):
+    if index is None:
+        index = header_index(data)
+    n = 0
+    for start, end in index.get(b'to', []) + index.get(b'cc', []):
+        for i in range(start, end):
+            s = data[i]
+            if i == start:
+                s = s[3:] # 'to:' / 'cc:'
+            for t in s.lower().translate(TO_CC_SEPARATORS).split():
+                if (b'@' in t) and (not b'"' in t) and (not b'\\' in t):
+                    if not (exclude and exclude.match(t)):
+                        n += 1
+    return n
+
+# the index is not valid after this
+def remove_agent_header(data, index=None):
+    if index is None:
+        index = header_index(data)
+    ranges = sorted(index.get(b'user-agent', []) + index.get(b'x-mailer', []))
+    if not ranges:
+        return
+
+    r = []
+    i = 0
+    for start, end in ranges:
+        r.extend(data[i:start])
+        i = end
+    r.extend(data[i:])
+    data[:] = r
+
+END_OF_DATA = b'\r\n.\r\n'
+
+# chunks of a dot-terminated block (DATA, multi-line POP response) that starts
+# a line, up to and including <CRLF>.<CRLF>; IncompleteReadError on EOF
+# bulk reads; byte reads only while a possible <CRLF>.<CRLF> straddles what
+# has been consumed
+async def read_to_dot(reader, label=None):
+    t = b'\r\n'
+    while True:
+        if t:
+            c = await reader.readexactly(1)
+            yield c
+            t += c
+            if t == END_OF_DATA:
+                break
+            while not END_OF_DATA.startswith(t):
+                t = t[1:]
+            continue
+        try:
+            c = await reader.readuntil(END_OF_DATA)
+        except asyncio.LimitOverrunError as ex:
+            c = await reader.readexactly(ex.consumed)
+            if label:
+                tap.put(label, c)
+            yield c
+            continue
+        if label:
+            tap.put(label, c)
+        yield c
+        break
+
+# dot-stuff a chunk of a BDAT mail for DATA; bol: the chunk starts a line
+def dot_stuff(s, bol):
+    s = s.replace(b'\n.', b'\n..')
+    if bol and s[:1] == b'.':
+        s = b'.' + s
+    return s
+
+# DATA section of a mail: header lines are kept in a list (for the checks and
+# rewrites), the body is spooled to memory or a temporary file
+class Message:
+    def __init__(self):
+        self.header = []
+        self.header_size = 0
+        self.body = tempfile.SpooledTemporaryFile(max_size=args.spool_size)
+        self.size = 0
+        self.oversize = False # over --smtp_size; the rest is not kept
+        self.raw = False # received by BDAT, not dot-stuffed
+        self.pending = b'' # BDAT: header not completed yet
+
+    def close(self):
+        self.body.close()
+
+    def check_size(self):
+        if args.smtp_size > 0 and self.header_size + self.size > args.smtp_size:
+            self.oversize = True
+        return self.oversize
+
+    def write_body(self, s):
+        self.size += len(s)
+        if not self.oversize and not self.check_size():
+            self.body.write(s)
+
+    # read until <CRLF>.<CRLF>; return False on EOF
+    async def read(self, reader, label=None):
+        while True:
+            s = await reader.readline()
+            if not s:
+                return False
+            if label:
+                print(f'{label} {s}')
+            if s == b'.\r\n':
+                return True
+            self.header.append(s)
+            self.header_size += len(s)
+            if s == b'\r\n':
+                break
+        self.check_size()
+
+        try:
+            async for c in read_to_dot(reader, label):
+                self.write_body(c)
+        except asyncio.IncompleteReadError:
+            return False
+
+        # strip '.\r\n' of <CRLF>.<CRLF>
+        self.size -= 3
+        if not self.oversize:
+            self.body.seek(self.size)
+            self.body.truncate()
+        return True
+
+    # read a BDAT chunk of n bytes; return False on EOF
+    async def read_chunk(self, reader, n, last, label=None):
+        self.raw = True
+        while n > 0:
+            s = await reader.read(min(n, args.buffer_size))
+            if not s:
+                return False
+            n -= len(s)
+            if label:
+                tap.put(label, s)
+            if self.pending is None:
+                self.write_body(s)
+            else:
+                self.feed_header(s)
+        if last:
+            if self.pending is not None: # no body
+                self.end_header(len(self.pending))
+            if label:
+                tap.put(label, None)
+        return True
+
+    def feed_header(self, s):
+        i = max(len(self.pending) - 3, 0)
+        self.pending += s
+        if self.pending.startswith(b'\r\n'):
+            self.end_header(2)
+            return
+        i = self.pending.find(b'\r\n\r\n', i)
+        if i >= 0:
+            self.end_header(i + 4)
+        elif args.smtp_size > 0 and len(self.pending) > args.smtp_size:
+            self.end_header(len(self.pending))
+
+    def end_header(self, n):
+        s, self.pending = self.pending, None
+        t = s[:n].split(b'\n')
+        self.header = [c + b'\n' for c in t[:-1]]
+        if t[-1]:
+            self.header.append(t[-1])
+        self.header_size = n
+        self.check_size()
+        if len(s) > n:
+            self.write_body(s[n:])
+
+    # header and body as received
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(b''.join(self.header))
+            self.body.seek(0)
+            shutil.copyfileobj(self.body, f, args.buffer_size)
+            f.flush()
+            os.fsync(f.fileno())
+
+    # bdat: send as one BDAT LAST chunk, else as DATA (dot-stuffed)
+    async def write(self, writer, label=None, bdat=False):
+        s = b''.join(self.header)
+        metrics.inc('o2pop_relay_bytes_total', len(s) + self.size, proto='smtp', direction='up')
+        if bdat:
+            t = b'BDAT %d LAST\r\n' % (len(s) + self.size)
+            if label:
+                print(f'{label} {t}')
+            writer.write(t)
+        if label:
+            for t in self.header:
+                print(f'{label} {t}')
+        stuff = self.raw and not bdat
+        if stuff:
+            s = dot_stuff(s, True)
+        tail = b'\r\n' + s[-2:]
+        writer.write(s)
+
+        size = args.buffer_size
+        self.body.seek(0)
+        while True:
+            s = self.body.read(size)
+            if not s:
+                break
+            if stuff:
+                s = dot_stuff(s, tail.endswith(b'\n'))
+            tail = tail[-2:] + s[-2:]
+            if label:
+                tap.put(label, s)
+            writer.write(s)
+            await timed_drain(writer, args.server_timeout)
+
+        if bdat:
+            if label:
+                tap.put(label, None)
+            return
+        s = b'.\r\n'
+        if not tail.endswith(b'\r\n'): # BDAT mail without the last CRLF
+            s = b'\r\n.\r\n'
+        if label:
+            tap.put(label, s)
+            tap.put(label, None)
+        writer.write(s)
+        await timed_drain(writer, args.server_timeout)
+
+# a mail saved by Message.save(); the header is sent as a part of the body
+def load_message(path, raw):
+    message = Message()
+    message.body.close()
+    message.body = open(path, 'rb')
+    message.size = os.path.getsize(path)
+    message.raw = raw
+    return message
+
+async def read_reply(reader, remote=None, lines=None):
+    # last line of a (multi-line) reply; b'' on EOF
+    while True:
+        s = await reader.readline()
+        if remote and args.verbose:
+            remote.print2("<<<", s)
+        if lines is not None:
+            lines.append(s)
+        if s[3:4] != b'-':
+            return s
+
+# authenticated connection to the upstream SMTP server
+class SmtpSession:
+    def __init__(self, key, reader, writer, count):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.count = count
+        self.expiry = None
+        self.extensions = {} # EHLO keyword -> params
+        self.error = b'' # the reply that failed envelope()
+        self.used = self.checked = time.monotonic()
+
+    def close(self):
+        self.writer.close()
+
+    def expired(self):
+        return self.expiry is not None and utcnow() >= self.expiry
+
+    async def command(self, s, remote=None, t=None):
+        if remote and args.verbose:
+            remote.print2("!>>", t or s)
+        self.writer.write(s)
+        await timed_drain(self.writer, args.server_timeout)
+        return await read_reply(self.reader, remote)
+
+    async def quit(self, remote=None):
+        await self.command(b'QUIT\r\n', remote)
+        self.close()
+
+    async def ehlo(self, remote=None):
+        s = b'EHLO [%b]\r\n' % params_main.ip_addr.encode()
+        if remote and args.verbose:
+            remote.print2("!>>", s)
+        self.writer.write(s)
+        await timed_drain(self.writer, args.server_timeout)
+        lines = []
+        s = await read_reply(self.reader, remote, lines)
+        self.extensions = {}
+        for t in lines[1:]:
+            t = t[4:].split()
+            if t:
+                self.extensions[t[0].upper()] = t[1:]
+        return s
+
+    # MAIL FROM:, RCPT TO: and DATA (pipelined if the server supports it)
+    # returns (reply to MAIL, err_msg, in_data); reply is b'' on EOF
+    # data: end with DATA, else the mail follows as BDAT
+    async def envelope(self, mail_cmd, rcpt_cmds, remote=None, data=True):
+        cmds = [mail_cmd] + rcpt_cmds
+        if data:
+            cmds.append(b'DATA\r\n')
+        replies = []
+        if b'PIPELINING' in self.extensions:
+            if remote and args.verbose:
+                for s in cmds:
+                    remote.print2("!>>", s)
+            self.writer.write(b''.join(cmds))
+            await timed_drain(self.writer, args.server_timeout)
+            for _ in cmds:
+                s = await read_reply(self.reader, remote)
+                replies.append(s)
+                if not s:
+                    break
+        else:
+            for t in cmds:
+                s = await self.command(t, remote)
+                replies.append(s)
+                if not s.startswith(b'250'):
+                    break
+
+        s = replies[0]
+        if not s.startswith(b'250'):
+            self.error = s
+            return s, b'552 MAIL command failed\r\n', False
+
+        in_data = data and len(replies) == len(cmds) and replies[-1].startswith(b'354')
+        for t, s in zip(rcpt_cmds, replies[1:]):
+            if not s.startswith(b'250'):
+                self.error = s
+                t = t.split(b':', 1)[-1].strip()
+                return replies[0], b'552 RCPT command failed %b: %b\r\n' % (t, s.rstrip()), in_data
+
+        if data and not in_data:
+            self.error = replies[-1] if len(replies) == len(cmds) else b''
+            return replies[0], b'552 DATA command failed\r\n', False
+        return replies[0], b'', True
+
+# returns (session, err_msg)
+async def smtp_connect(params, user, token, remote):
+    verbose = args.verbose
+
+    # connect to remote server
+    if verbose:
+        print(f'[{remote.count}] Connect to {params.remote_smtp_host}:{params.remote_smtp_port}')
+
+    ctx = get_ssl_context(params.remote_smtp_host)
+
+    if params.remote_smtp_port == 587:
+        start_tls_ctx = ctx
+        ctx = None
+    else:
+        start_tls_ctx = None
+
+    remote.phase('connect')
+    t = time.monotonic()
+    remote_reader, remote_writer = await open_upstream(
+        params.remote_smtp_host, params.remote_smtp_port, ctx, user.decode())
+    remote.reader, remote.writer = remote_reader, remote_writer
+    metrics.observe('o2pop_upstream_connect_seconds', time.monotonic() - t, proto='smtp')
+    remote.phase('upstream_auth')
+    session = SmtpSession(params.get_token_file(user.decode()), remote_reader, remote_writer, remote.count)
+
+    # <<< 220 ... Service ready
+    s = await read_reply(remote_reader, remote)
+    if not s.startswith(b'220'):
+        return None, s
+
+    # EHLO
+    s = await session.ehlo(remote)
+    if not s.startswith(b'250'):
+        await session.quit(remote)
+        return None, b'552 EHLO command failed\r\n'
+
+    if start_tls_ctx:
+        remote.phase('tls')
+        s = await session.command(b'STARTTLS\r\n', remote)
+        if not s.startswith(b'220'):
+            await session.quit(remote)
+            return None, b'552 STARTTLS command failed\r\n'
+
+        transport = remote_writer.transport
+        protocol = transport.get_protocol()
+        protocol._over_ssl = True
+        loop = asyncio.get_event_loop()
+
+        tls_transport = await wait_timeout(loop.start_tls(transport, protocol, start_tls_ctx,
+            server_hostname=params.remote_smtp_host), args.connect_timeout, 'STARTTLS')
+        remote_writer._transport = tls_transport
+        remote_reader._transport = tls_transport
+        remote.phase('upstream_auth')
+
+        if params.mode == MS_MODE:
+            # EHLO after STARTTLS
+            s = await session.ehlo(remote)
+            if not s.startswith(b'250'):
+                await session.quit(remote)
+                return None, b'552 EHLO command failed\r\n'
+
+    auth_string = b'user=%b\1auth=Bearer %b\1\1' % (user, token)
+    auth_b64 = base64.b64encode(auth_string)
+    s = b'AUTH XOAUTH2 %b\r\n' % auth_b64
+
+    t = None
+    if args.verbose == 1:
+        blen = '*{' + str(len(auth_b64)) + '}'
+        t = b'AUTH XOAUTH2 %b\r\n' % blen.encode()
+
+    # OK: <<< 235 2.7.0 Accepted
+    # NG: <<< 334 eyJzdGF0d...
+    login_start = time.monotonic()
+    s = await session.command(s, remote, t)
+    metrics.observe('o2pop_login_seconds', time.monotonic() - login_start, proto='smtp')
+    save_ssl_session(ctx or start_tls_ctx, remote_writer, remote.count)
+
+    if not s.startswith(b'235'):
+        metrics.inc('o2pop_login_failures_total', proto='smtp')
+        if s.startswith(b'334'):
+            await session.command(b'\r\n', remote)
+        await session.quit(remote)
+        return None, b'552 Authentication failed\r\n'
+
+    session.expiry = params.get_expiry(user.decode())
+    return session, None
+
+# idle upstream SMTP sessions per account (--smtp_pool)
+# a pooled session or a new login; returns (session, err_msg, reused)
+async def smtp_open(params, user, key, remote):
+    verbose = args.verbose
+    session = smtp_pool.get(key)
+    if session:
+        if verbose:
+            print(f'[{remote.count}] Reuse connection [{session.count}]')
+        remote.reader, remote.writer = session.reader, session.writer
+        return session, b'', True
+
+    await remote.acquire(key)
+    try:
+        token = (await params.get_token_async(user.decode())).encode()
+    except TokenError as ex:
+        if verbose:
+            print(f'[{remote.count}] {ex}')
+        return None, b'454 4.7.0 Failed to get auth-token\r\n', False
+    finally:
+        remote.release()
+
+    try:
+        session, err_msg = await smtp_connect(params, user, token, remote)
+    except LimitError as ex:
+        if verbose:
+            print(f'[{remote.count}] {ex}')
+        session, err_msg = None, b'421 4.7.0 Too many connections, try again later\r\n'
+    return session, err_msg, False
+
+class SmtpPool:
+    def __init__(self):
+        self.idle = {} # token file -> [SmtpSession]
+
+    def get(self, key):
+        idle = self.idle.get(key)
+        while idle:
+            session = idle.pop()
+            if not session.expired() and not session.writer.is_closing():
+                return session
+            session.close()
+        return None
+
+    async def release(self, session, remote=None):
+        idle = self.idle.setdefault(session.key, [])
+        if len(idle) >= args.smtp_pool or session.expired():
+            await session.quit(remote)
+            return
+
+        s = await session.command(b'RSET\r\n', remote)
+        if not s.startswith(b'250'):
+            session.close()
+            return
+        session.used = session.checked = time.monotonic()
+        idle.append(session)
+
+    async def keepalive(self):
+        try:
+            while True:
+                await asyncio.sleep(SMTP_NOOP_INTERVAL)
+                for idle in list(self.idle.values()):
+                    for session in idle[:]:
+                        now = time.monotonic()
+                        if now - session.checked < SMTP_NOOP_INTERVAL:
+                            continue
+                        idle.remove(session)
+                        try:
+                            if session.expired() or now - session.used >= SMTP_POOL_IDLE:
+                                await session.quit()
+                                continue
+                            s = await session.command(b'NOOP\r\n')
+                        except (OSError, asyncio.IncompleteReadError) as ex:
+                            if args.verbose:
+                                print(f'[{session.count}] {ex}')
+                            session.close()
+                            continue
+                        if s.startswith(b'250'):
+                            session.checked = time.monotonic()
+                            idle.append(session)
+                        else:
+                            session.close()
+        finally:
+            for idle in self.idle.values():
+                for session in idle:
+                    session.close()
+            self.idle.clear()
+
+smtp_pool = None
+
+# a mail waiting for the send delay (the body stays in its spool)
+class HeldMail:
+    def __init__(self, hold_id, env_from, rcpt_count):
+        self.id = hold_id
+        self.env_from = env_from
+        self.rcpt_count = rcpt_count
+        self.future = asyncio.get_running_loop().create_future()
+
+# held mails by id; confirm() / cancel() may be called from other threads
+class HoldQueue:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.held = {}
+        self.next_id = 1
+
+    def add(self, env_from, rcpt_count):
+        mail = HeldMail(self.next_id, env_from, rcpt_count)
+        self.next_id += 1
+        self.held[mail.id] = mail
+        return mail
+
+    # True: send, False: cancelled; sent when the timeout expires
+    async def wait(self, mail, timeout):
+        t = time.monotonic()
+        try:
+            return await asyncio.wait_for(mail.future, timeout)
+        except asyncio.TimeoutError:
+            return True
+        finally:
+            metrics.observe('o2pop_queue_wait_seconds', time.monotonic() - t, queue='hold')
+            self.held.pop(mail.id, None)
+
+    def resolve(self, hold_id, send):
+        mail = self.held.get(hold_id)
+        if mail and not mail.future.done():
+            mail.future.set_result(send)
+
+    def confirm(self, hold_id):
+        self.loop.call_soon_threadsafe(self.resolve, hold_id, True)
+
+    def cancel(self, hold_id):
+        self.loop.call_soon_threadsafe(self.resolve, hold_id, False)
+
+hold_queue = None
+
+# store-and-forward (--spool): <id>.eml is the mail as received, <id>.json
+# the envelope and the delivery state; the json is written last, so a mail
+# without it was not accepted
+class Outbox:
+    def __init__(self, path):
+        self.path = path
+        self.queue = {} # id -> meta
+        self.busy = set() # ids being delivered
+        self.accounts = {} # user -> number of deliveries
+        self.tasks = set()
+        self.wakeup = asyncio.Event()
+        self.next_id = 0
+
+    def load(self):
+        os.makedirs(self.path, exist_ok=True)
+        for name in os.listdir(self.path):
+            mail_id, ext = os.path.splitext(name)
+            if ext == '.json':
+                with open(os.path.join(self.path, name), 'r') as f:
+                    meta = json.load(f)
+                if not meta['failed']:
+                    self.queue[mail_id] = meta
+            elif ext == '.eml':
+                if not os.path.exists(os.path.join(self.path, mail_id + '.json')):
+                    os.remove(os.path.join(self.path, name))
+
+    def save(self, meta, message):
+        message.save(os.path.join(self.path, meta['id'] + '.eml'))
+        self.write_meta(meta)
+
+    def write_meta(self, meta):
+        path = os.path.join(self.path, meta['id'] + '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def remove(self, mail_id):
+        for ext in ('.json', '.eml'):
+            try:
+                os.remove(os.path.join(self.path, mail_id + ext))
+            except FileNotFoundError:
+                pass
+
+    async def put(self, user, mail_cmd, rcpt_cmds, message):
+        self.next_id += 1
+        now = time.time()
+        meta = {
+            'id': f'{int(now * 1000):x}-{self.next_id}',
+            'user': user,
+            'mail_cmd': mail_cmd.decode(errors='surrogateescape'),
+            'rcpt_cmds': [t.decode(errors='surrogateescape') for t in rcpt_cmds],
+            'raw': message.raw,
+            'created': now,
+            'attempts': 0,
+            'next_try': now,
+            'error': '',
+            'failed': False,
+        }
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.save, meta, message)
+        self.queue[meta['id']] = meta
+        self.wakeup.set()
+        return meta['id']
+
+    async def run(self):
+        self.load()
+        try:
+            while True:
+                now = time.time()
+                wait = SPOOL_RETRY_MAX
+                for mail_id, meta in sorted(self.queue.items()):
+                    if mail_id in self.busy:
+                        continue
+                    if meta['next_try'] > now:
+                        wait = min(wait, meta['next_try'] - now)
+                        continue
+                    user = meta['user']
+                    if self.accounts.get(user, 0) >= args.spool_concurrency:
+                        continue
+                    self.busy.add(mail_id)
+                    self.accounts[user] = self.accounts.get(user, 0) + 1
+                    task = asyncio.create_task(self.deliver(meta))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in list(self.tasks):
+                task.cancel()
+
+    async def deliver(self, meta):
+        mail_id = meta['id']
+        try:
+            s, permanent = await spool_deliver(meta, os.path.join(self.path, mail_id + '.eml'))
+        except (OSError, asyncio.IncompleteReadError) as ex:
+            s, permanent = str(ex).encode(), False
+        except Exception as ex: # retried later like a network error
+            s, permanent = f'{type(ex).__name__}: {ex}'.encode(), False
+            print(f'[spool] {mail_id}: {s.decode(errors="replace")}')
+        finally:
+            self.busy.discard(mail_id)
+            self.accounts[meta['user']] -= 1
+            self.wakeup.set()
+
+        if s.startswith(b'250'):
+            if args.verbose: # debug
+                print(f'[spool] Sent {mail_id}')
+            del self.queue[mail_id]
+            self.remove(mail_id)
+            return
+
+        now = time.time()
+        meta['attempts'] += 1
+        meta['error'] = s.decode(errors='replace').rstrip()
+        meta['next_try'] = now + min(SPOOL_RETRY * 2 ** (meta['attempts'] - 1), SPOOL_RETRY_MAX)
+        if permanent or now - meta['created'] > SPOOL_EXPIRE:
+            meta['failed'] = True
+            del self.queue[mail_id]
+        if args.verbose: # debug
+            state = 'Failed' if meta['failed'] else 'Retry'
+            print(f'[spool] {state} {mail_id}: {meta["error"]}')
+        self.write_meta(meta)
+
+outbox = None
+
+# returns (reply, permanent)
+async def spool_deliver(meta, path):
+    user_d = meta['user']
+    user = user_d.encode()
+    params = args.user_params.get(user_d, params_main)
+    key = params.get_token_file(user_d)
+    mail_cmd = meta['mail_cmd'].encode(errors='surrogateescape')
+    rcpt_cmds = [t.encode(errors='surrogateescape') for t in meta['rcpt_cmds']]
+
+    remote = Conn()
+    if args.verbose: # debug
+        print(f'[{remote.count}] Spool {meta["id"]} ({user_d})')
+    try:
+        while True:
+            session, err_msg, reused = await smtp_open(params, user, key, remote)
+            if not session:
+                return err_msg, False
+            bdat = meta['raw'] and b'CHUNKING' in session.extensions
+            s, err_msg, in_data = await session.envelope(mail_cmd, rcpt_cmds, remote, not bdat)
+            if s or not reused:
+                break
+            session.close()
+
+        if err_msg:
+            if in_data:
+                session.close()
+            else:
+                await smtp_pool.release(session, remote)
+            return session.error, session.error.startswith(b'5')
+
+        message = load_message(path, meta['raw'])
+        try:
+            await message.write(remote.writer, args.verbose and f'!>>[{remote.count}]', bdat)
+        finally:
+            message.close()
+        s = await read_reply(remote.reader, remote)
+        if s.startswith(b'250'):
+            await smtp_pool.release(session, remote)
+        else:
+            session.close()
+        return s, s.startswith(b'5')
+    except:
+        if remote.writer:
+            remote.writer.close()
+        raise
+    finally:
+        remote.release()
+
+def print_spool(store_dir):
+    path = os.path.join(store_dir, 'spool')
+    names = []
+    if os.path.isdir(path):
+        names = sorted(t for t in os.listdir(path) if t.endswith('.json'))
+    if not names:
+        print('spool: empty')
+        return
+    for name in names:
+        with open(os.path.join(path, name), 'r') as f:
+            meta = json.load(f)
+        if meta['failed']:
+            state = 'failed'
+        elif meta['attempts']:
+            state = 'retry at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(meta['next_try']))
+        else:
+            state = 'queued'
+        created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(meta['created']))
+        print(f"{meta['id']}  {created}  {meta['user']}  rcpt: {len(meta['rcpt_cmds'])}  {state}")
+        if meta['error']:
+            print(f"    {meta['attempts']} attempts, last: {meta['error']}")
 
 async def smtp_init(local_reader, local_writer, remote):
     verbose = args.verbose
@@ -611,6 +3194,7 @@ async def smtp_init(local_reader, local_writer, remote):
         print2("<<!", s)
     local_writer.write(s)
     await local_writer.drain()
+    remote.phase('client_auth')
 
     # QUIT / EHLO / HELO
     if local_reader.at_eof():
@@ -643,7 +3227,8 @@ async def smtp_init(local_reader, local_writer, remote):
         await local_writer.drain()
         return 1
     if cmd.startswith(b'ehlo '):
-        s = b'250-localhost\r\n250-AUTH LOGIN PLAIN\r\n250 8BITMIME\r\n'
+        s = (b'250-localhost\r\n250-AUTH LOGIN PLAIN\r\n250-8BITMIME\r\n'
+            b'250-PIPELINING\r\n250-CHUNKING\r\n250 SIZE %d\r\n' % max(args.smtp_size, 0))
     elif cmd.startswith(b'helo '):
         s = b'250 Hello\r\n'
     else:
@@ -743,6 +3328,7 @@ async def smtp_init(local_reader, local_writer, remote):
             print2("<<!", s)
         local_writer.write(s)
         await local_writer.drain()
+        remote.logged_in()
 
         # QUIT / MAIL FROM:
         if local_reader.at_eof():
@@ -765,446 +3351,399 @@ async def smtp_init(local_reader, local_writer, remote):
         else:
             return 1
 
-    s = b'250 OK\r\n'
-    if verbose:
-        print2("<<!", s)
-    local_writer.write(s)
-    await local_writer.drain()
-
     parent = params_main.parent
 
     block_list_parsed = False
     if parent:
         block_list_parsed = parent.block_list_parsed
 
-    # QUIT / RCPT TO: / DATA
-    rcpt_cmds = []
-    while True:
-        if local_reader.at_eof():
-            return 1
-        s = await local_reader.readline()
-        if verbose:
-            print2(">>>", s)
-
-        cmd = s.lower().rstrip()
-        if cmd == b'quit':
-            s = b'221 Bye\r\n'
-            if verbose:
-                print2("<<!", s)
-            local_writer.write(s)
-            await local_writer.drain()
-            return 1
-
-        if cmd.startswith(b'rcpt '):
-            if block_list_parsed: # Check block list
-                t = cmd.split(b':', 1)
-                if len(t) == 2:
-                    email = t[1].split()[0].strip(b'<>')
-                else:
-                    email = b''
-                matched = False
-                for t, is_email in block_list_parsed:
-                    if is_email:
-                        if t == email:
-                            matched = True
-                            break
-                    else:
-                        if email.endswith(t):
-                            matched = True
-                            break
-                if matched:
-                    err = True
-                    s = b'552 Matched block list\r\n'
-                    if verbose:
-                        print2("<<!", s)
-                    local_writer.write(s)
-                    await local_writer.drain()
-                    return 1
-            rcpt_cmds.append(s)
-            s = b'250 OK\r\n'
-            if verbose:
-                print2("<<!", s)
-            local_writer.write(s)
-            await local_writer.drain()
-        elif cmd == b'data':
-            if rcpt_cmds:
-                break
-            s = b'503 RCPT first.\r\n'
-            if verbose:
-                print2("<<!", s)
-            local_writer.write(s)
-            await local_writer.drain()
-        else:
-            return 1
-
-    s = b'354 Start mail input; end with <CRLF>.<CRLF>\r\n'
-    if verbose:
-        print2("<<!", s)
-    local_writer.write(s)
-    await local_writer.drain()
-
-    data = []
-    while True:
-        if local_reader.at_eof():
-            return 1
-        s = await local_reader.readline()
-        if verbose:
-            print2(">>>", s)
-        data.append(s)
-        if s == b'.\r\n':
-            break
-
-    if parent:
-        block_smtp = parent.block_smtp
-
-        to_cc_max = parent.to_cc_max
-        to_cc_exclude = parent.to_cc_exclude.encode()
-        err = False
-        if to_cc_max > 0:
-            n = to_cc_count(data, to_cc_exclude)
-            if n > to_cc_max:
-                err = True
-                s = b'552 Too many addresses in To and Cc fields\r\n'
-
-        if not err and parent.send_delay > 0:
-            parent.rcpt_count = len(rcpt_cmds)
-            parent.env_from = env_from.decode()
-
-            block_smtp.cancel = False
-            block_smtp.run()
-
-            task = asyncio.create_task(asyncio.sleep(60))
-            block_smtp.task = task
-            try:
-                await asyncio.wait_for(task, timeout=None)
-            except asyncio.CancelledError:
-                pass
-
-            if block_smtp.cancel:
-                err = True
-                s = b'552 Requested action aborted\r\n'
-        
-        if err:
-            if verbose:
-                print2("<<!", s)
-            local_writer.write(s)
-            await local_writer.drain()
-            return 1
-
-        if parent.remove_header:
-            remove_agent_header(data)
-
-    while Conn.lock >= 0:
-        if verbose:
-            print(f'[{remote.count}] Locked by [{Conn.lock}]') # debug
-        await asyncio.sleep(1)
-    Conn.lock = remote.count
-
+    remote.user = user
     user_d = user.decode()
     if user_d in args.user_params:
-        params = args.user_params[user_d]
-    else:
-        params = params_main
-
-    token = params.get_token(user_d).encode()
-
-    # connect to remote server
-    if verbose:
-        print(f'[{remote.count}] Connect to {params.remote_smtp_host}:{params.remote_smtp_port}')
-
-    ctx = ssl.create_default_context()
-    if args.ca_file:
-        ctx.load_verify_locations(cafile=args.ca_file)
-
-    if params.remote_smtp_port == 587:
-        start_tls_ctx = ctx
-        ctx = None
-    else:
-        start_tls_ctx = None
-
-    remote_reader, remote_writer = await asyncio.open_connection(
-        params.remote_smtp_host, params.remote_smtp_port, ssl=ctx)
-    remote.reader, remote.writer = remote_reader, remote_writer
-
-    err = False
-    err_msg = b''
-
-    # <<< 220 ... Service ready
-    if remote_reader.at_eof():
-        return 1
-    s = await remote_reader.readline()
-    if verbose:
-        print2("<<<", s)
-    if not s.startswith(b'220'):
+        params = args.user_params[user_d]
+    else:
+        params = params_main
+    key = params.get_token_file(user_d)
+
+    if not await account_limit.enter(user_d):
+        s = b'421 4.7.0 Too many connections for the account\r\n'
+        if verbose:
+            print2("<<!", s)
         local_writer.write(s)
         await local_writer.drain()
         return 1
+    remote.account = user_d
+
+    session = None
+    while True: # one mail transaction per loop
+        remote.phase('client')
+        if not mail_cmd:
+            # QUIT / RSET / NOOP / MAIL FROM:
+            mail_cmd = await smtp_next_mail(local_reader, local_writer, remote)
+            if not mail_cmd:
+                if session:
+                    await smtp_pool.release(session, remote)
+                    remote.writer = None
+                return 1
 
-    # EHLO
-    s = b'EHLO [%b]\r\n' % params_main.ip_addr.encode()
-    if verbose:
-        print2("!>>", s)
-    remote_writer.write(s)
-    await remote_writer.drain()
-
-    while True:
-        if remote_reader.at_eof():
-            return 1
-        s = await remote_reader.readline()
-        if verbose:
-            print2("<<<", s)
-        if s[3:4] == b' ':
-            break
-    if not s.startswith(b'250'):
-        err = True
-        err_msg = b'552 EHLO command failed\r\n'
+        if args.smtp_size > 0 and mail_size(mail_cmd) > args.smtp_size:
+            s = b'552 5.3.4 Message size exceeds fixed maximum message size\r\n'
+            if verbose:
+                print2("<<!", s)
+            local_writer.write(s)
+            await local_writer.drain()
+            mail_cmd = b''
+            continue
 
-    if not err and start_tls_ctx:
-        s = b'STARTTLS\r\n'
+        s = b'250 OK\r\n'
         if verbose:
-            print2("!>>", s)
-        remote_writer.write(s)
-        await remote_writer.drain()
+            print2("<<!", s)
+        local_writer.write(s)
+        await local_writer.drain()
 
-        if remote_reader.at_eof():
-            return 1
+        t = mail_cmd.split(b':', 1)
+        if len(t) == 2 and t[1].split():
+            env_from = t[1].split()[0].strip(b'<>')
 
-        s = await remote_reader.readline()
-        if verbose:
-            print2("<<<", s)
-        if not s.startswith(b'220'):
-            err = True
-            err_msg = b'552 STARTTLS command failed\r\n'
+        # QUIT / RSET / NOOP / RCPT TO: / DATA / BDAT
+        rcpt_cmds = []
+        while True:
+            if local_reader.at_eof():
+                return 1
+            s = await local_reader.readline()
+            if verbose:
+                print2(">>>", s)
 
-        if not err:
-            transport = remote_writer.transport
-            protocol = transport.get_protocol()
-            protocol._over_ssl = True
-            loop = asyncio.get_event_loop()
+            cmd = s.lower().rstrip()
+            if cmd == b'quit':
+                s = b'221 Bye\r\n'
+                if verbose:
+                    print2("<<!", s)
+                local_writer.write(s)
+                await local_writer.drain()
+                if session:
+                    await smtp_pool.release(session, remote)
+                    remote.writer = None
+                return 1
 
-            tls_transport = await loop.start_tls(transport, protocol, start_tls_ctx)
-            remote_writer._transport = tls_transport
-            remote_reader._transport = tls_transport
+            if cmd == b'rset' or cmd == b'noop':
+                s = b'250 OK\r\n'
+                if verbose:
+                    print2("<<!", s)
+                local_writer.write(s)
+                await local_writer.drain()
+                if cmd == b'rset':
+                    break
+            elif cmd.startswith(b'rcpt '):
+                if block_list_parsed: # Check block list
+                    t = cmd.split(b':', 1)
+                    if len(t) == 2:
+                        email = t[1].split()[0].strip(b'<>')
+                    else:
+                        email = b''
+                    if block_list_parsed.match(email):
+                        s = b'552 Matched block list\r\n'
+                        if verbose:
+                            print2("<<!", s)
+                        local_writer.write(s)
+                        await local_writer.drain()
+                        cmd = b'rset' # the whole mail is refused
+                        break
+                rcpt_cmds.append(s)
+                s = b'250 OK\r\n'
+                if verbose:
+                    print2("<<!", s)
+                local_writer.write(s)
+                await local_writer.drain()
+            elif cmd == b'data':
+                if rcpt_cmds:
+                    break
+                s = b'503 RCPT first.\r\n'
+                if verbose:
+                    print2("<<!", s)
+                local_writer.write(s)
+                await local_writer.drain()
+            elif cmd.startswith(b'bdat '):
+                if rcpt_cmds:
+                    break
+                n, last = bdat_args(cmd)
+                if n < 0 or not await smtp_skip(local_reader, n):
+                    return 1
+                s = b'503 RCPT first.\r\n'
+                if verbose:
+                    print2("<<!", s)
+                local_writer.write(s)
+                await local_writer.drain()
+            else:
+                return 1
 
-        if not err and params.mode == MS_MODE:
-            # EHLO after STARTTLS
-            s = b'EHLO [%b]\r\n' % params_main.ip_addr.encode()
+        message = Message()
+        if cmd == b'data':
+            s = b'354 Start mail input; end with <CRLF>.<CRLF>\r\n'
             if verbose:
-                print2("!>>", s)
-            remote_writer.write(s)
-            await remote_writer.drain()
+                print2("<<!", s)
+            local_writer.write(s)
+            await local_writer.drain()
 
-            while True:
-                if remote_reader.at_eof():
-                    return 1
-                s = await remote_reader.readline()
-                if verbose:
-                    print2("<<<", s)
-                if s[3:4] == b' ':
-                    break
-            if not s.startswith(b'250'):
-                err = True
-                err_msg = b'552 EHLO command failed\r\n'
+            if not await message.read(local_reader, verbose and f'>>>[{remote.count}]'):
+                return 1
+        elif cmd != b'rset':
+            cmd = await smtp_read_bdat(local_reader, local_writer, remote, message, cmd)
+            if cmd == b'quit':
+                if session:
+                    await smtp_pool.release(session, remote)
+                    remote.writer = None
+                return 1
+            if not cmd:
+                return 1
 
-    if err:
-        s = b'QUIT\r\n'
-        if verbose:
-            print2("!>>", s)
-        remote_writer.write(s)
-        await remote_writer.drain()
-        if remote_reader.at_eof():
-            return 1
-        s = await remote_reader.readline()
-        if verbose:
-            print2("<<<", s)
-        s = err_msg
-        if verbose:
-            print2("<<!", s)
-        local_writer.write(s)
-        await local_writer.drain()
+        if cmd == b'rset':
+            message.close()
+            mail_cmd = b''
+            continue
 
-        return 1
+        if message.oversize:
+            message.close()
+            s = b'552 5.3.4 Message size exceeds fixed maximum message size\r\n'
+            if verbose:
+                print2("<<!", s)
+            local_writer.write(s)
+            await local_writer.drain()
+            mail_cmd = b''
+            continue
+        data = message.header
 
-    auth_string = b'user=%b\1auth=Bearer %b\1\1' % (user, token)
-    auth_b64 = base64.b64encode(auth_string)
-    s = b'AUTH XOAUTH2 %b\r\n' % auth_b64
+        if parent:
+            index = header_index(data)
 
-    if verbose:
-        if args.verbose == 1:
-            blen = '*{' + str(len(auth_b64)) + '}'
-            t = b'AUTH XOAUTH2 %b\r\n' % blen.encode()
-            print2("!>>", t)
-        else:
-            print2("!>>", s)
-    remote_writer.write(s)
-    await remote_writer.drain()
+            to_cc_max = parent.to_cc_max
+            to_cc_exclude = parent.to_cc_exclude_parsed
+            err = False
+            if to_cc_max > 0:
+                n = to_cc_count(data, to_cc_exclude, index)
+                if n > to_cc_max:
+                    err = True
+                    s = b'552 Too many addresses in To and Cc fields\r\n'
+
+            if not err and parent.send_delay > 0:
+                remote.phase('hold')
+                mail = hold_queue.add(env_from.decode(), len(rcpt_cmds))
+                if verbose: # debug
+                    print(f'[{remote.count}] Hold #{mail.id}')
+                parent.block_smtp.run(mail)
+
+                if not await hold_queue.wait(mail, args.hold_timeout):
+                    if verbose: # debug
+                        print(f'[{remote.count}] Cancel #{mail.id}')
+                    err = True
+                    s = b'552 Requested action aborted\r\n'
+            
+            if err:
+                message.close()
+                if verbose:
+                    print2("<<!", s)
+                local_writer.write(s)
+                await local_writer.drain()
+                mail_cmd = b''
+                continue
 
-    # OK: <<< 235 2.7.0 Accepted
-    # NG: <<< 334 eyJzdGF0d...
-    if remote_reader.at_eof():
-        return 1
-    s = await remote_reader.readline()
-    if verbose:
-        print2("<<<", s)
+            if parent.remove_header:
+                remove_agent_header(data, index)
 
-    if s.startswith(b'235'):
         # MAIL FROM:
-        s = mail_cmd
         if parent and parent.change_env_from: # Change Envelope-From
             env_from = user
-            t = s.split(b':', 1)
+            t = mail_cmd.split(b':', 1)
             if len(t) == 2:
                 t1 = t[1].split(b' ', 1)
                 if len(t1) == 2:
-                    s = b'MAIL FROM:<' + user + b'> ' + t1[1]
+                    mail_cmd = b'MAIL FROM:<' + user + b'> ' + t1[1]
                 else:
-                    s = b'MAIL FROM:<' + user + b'>\r\n'
-        if verbose:
-            print2("!>>", s)
-        remote_writer.write(s)
-        await remote_writer.drain()
+                    mail_cmd = b'MAIL FROM:<' + user + b'>\r\n'
 
-        while True:
-            if remote_reader.at_eof():
-                return 1
-            s = await remote_reader.readline()
-            if verbose:
-                print2("<<<", s)
-            if s[3:4] == b' ':
-                break
-
-        if not s.startswith(b'250'):
-            err = True
-            err_msg = b'552 MAIL command failed\r\n'
-    else:
-        if s.startswith(b'334'):
-            s = b'\r\n'
-            if verbose:
-                print2("!>>", s)
-            remote_writer.write(s)
-            await remote_writer.drain()
-
-            while True:
-                if remote_reader.at_eof():
-                    return 1
-                s = await remote_reader.readline()
+        if outbox: # store-and-forward
+            remote.phase('spool')
+            try:
+                mail_id = await outbox.put(user_d, mail_cmd, rcpt_cmds, message)
+                s = b'250 2.0.0 OK queued as %b\r\n' % mail_id.encode()
+            except OSError as ex:
                 if verbose:
-                    print2("<<<", s)
-                if s[3:4] == b' ':
-                    break
-        err = True
-        err_msg = b'552 Authentication failed\r\n'
-
-    # RCPT TO:
-    if not err:
-        for s in rcpt_cmds:
+                    print(f'[{remote.count}] {ex}')
+                s = b'452 4.3.1 Insufficient system storage\r\n'
+            message.close()
             if verbose:
-                print2("!>>", s)
-            remote_writer.write(s)
-            await remote_writer.drain()
+                print2("<<!", s)
+            local_writer.write(s)
+            await local_writer.drain()
+            mail_cmd = b''
+            continue
 
-            while True:
-                if remote_reader.at_eof():
-                    return 1
-                s = await remote_reader.readline()
-                if verbose:
-                    print2("<<<", s)
-                if s[3:4] == b' ':
+        # the connection of the previous mail is used first
+        while True:
+            reused = session is not None
+            if reused:
+                remote.phase('send')
+                remote.reader, remote.writer = session.reader, session.writer
+            else:
+                session, err_msg, reused = await smtp_open(params, user, key, remote)
+                if not session:
                     break
+                remote.phase('send')
 
-            if not s.startswith(b'250'):
-                err = True
-                err_msg = b'552 RCPT command failed\r\n'
+            # MAIL FROM: / RCPT TO: / DATA
+            bdat = message.raw and b'CHUNKING' in session.extensions
+            s, err_msg, in_data = await session.envelope(mail_cmd, rcpt_cmds, remote, not bdat)
+            if s or not reused:
                 break
+            # the connection was closed by the server
+            session.close()
+            session = remote.writer = None
 
-    # DATA:
-    if not err:
-        s = b'DATA\r\n'
-        if verbose:
-            print2("!>>", s)
-        remote_writer.write(s)
-        await remote_writer.drain()
-        if remote_reader.at_eof():
+        if not session and not err_msg:
             return 1
-        s = await remote_reader.readline()
-        if verbose:
-            print2("<<<", s)
-        if not s.startswith(b'354'):
-            err = True
-            err_msg = b'552 DATA command failed\r\n'
+        if err_msg:
+            message.close()
+            if session:
+                if in_data or not s: # pipelined DATA was accepted (abort it) or EOF
+                    session.close()
+                else:
+                    try:
+                        await smtp_pool.release(session, remote)
+                    except (OSError, asyncio.IncompleteReadError):
+                        session.close()
+                session = None
+            elif remote.writer: # the login failed
+                remote.writer.close()
+            remote.writer = None
+            s = err_msg
+            if verbose:
+                print2("<<!", s)
+            local_writer.write(s)
+            await local_writer.drain()
+            mail_cmd = b''
+            continue
 
-    if err:
-        s = b'QUIT\r\n'
-        if verbose:
-            print2("!>>", s)
-        remote_writer.write(s)
-        await remote_writer.drain()
-        if remote_reader.at_eof():
+        await message.write(remote.writer, verbose and f'!>>[{remote.count}]', bdat)
+        message.close()
+        s = await read_reply(remote.reader, remote)
+        if not s:
             return 1
-        s = await remote_reader.readline()
-        if verbose:
-            print2("<<<", s)
-        s = err_msg
+        local_writer.write(s)
+        await local_writer.drain()
+        mail_cmd = b''
+
+# SIZE= of MAIL FROM:
+def mail_size(mail_cmd):
+    for t in mail_cmd.split()[1:]:
+        if t.lower().startswith(b'size='):
+            try:
+                return int(t[5:])
+            except ValueError:
+                break
+    return 0
+
+# BDAT <size> [LAST] -> (size, last); size is -1 on a syntax error
+def bdat_args(cmd):
+    t = cmd.split()
+    if len(t) < 2 or len(t) > 3 or not t[1].isdigit():
+        return -1, False
+    if len(t) == 3 and t[2] != b'last':
+        return -1, False
+    return int(t[1]), len(t) == 3
+
+# discard n bytes; return False on EOF
+async def smtp_skip(local_reader, n):
+    while n > 0:
+        s = await local_reader.read(min(n, args.buffer_size))
+        if not s:
+            return False
+        n -= len(s)
+    return True
+
+# read BDAT chunks into message until LAST
+# returns b'bdat' when done, b'rset' / b'quit' as received, b'' on error
+async def smtp_read_bdat(local_reader, local_writer, remote, message, cmd):
+    verbose = args.verbose
+    print2 = remote.print2
+    label = verbose and f'>>>[{remote.count}]'
+    while True:
+        if cmd.startswith(b'bdat '):
+            n, last = bdat_args(cmd)
+            if n < 0:
+                return b''
+            if not await message.read_chunk(local_reader, n, last, label):
+                return b''
+            if last:
+                return b'bdat'
+            s = b'250 %d octets received\r\n' % n
+        elif cmd == b'rset' or cmd == b'noop':
+            s = b'250 OK\r\n'
+        elif cmd == b'quit':
+            s = b'221 Bye\r\n'
+        else:
+            return b''
         if verbose:
             print2("<<!", s)
         local_writer.write(s)
         await local_writer.drain()
+        if cmd == b'rset' or cmd == b'quit':
+            return cmd
 
-        return 1
-
-    Conn.lock = -1
+        if local_reader.at_eof():
+            return b''
+        s = await local_reader.readline()
+        if verbose:
+            print2(">>>", s)
+        cmd = s.lower().rstrip()
 
-    for s in data:
+# wait for the next MAIL command; b'' on QUIT or error
+async def smtp_next_mail(local_reader, local_writer, remote):
+    verbose = args.verbose
+    print2 = remote.print2
+    while True:
+        if local_reader.at_eof():
+            return b''
+        s = await local_reader.readline()
         if verbose:
-            print2("!>>", s)
-        remote_writer.write(s)
-        await remote_writer.drain()
-    if remote_reader.at_eof():
-        return 1
-    s = await remote_reader.readline()
-    if verbose:
-        print2("<<<", s)
-    local_writer.write(s)
-    await local_writer.drain()
+            print2(">>>", s)
 
-    # QUIT
-    if local_reader.at_eof():
-        return 1
-    s = await local_reader.readline()
-    if verbose:
-        print2(">>>", s)
-    cmd = s.lower().rstrip()
+        cmd = s.lower().rstrip()
+        if cmd.startswith(b'mail '):
+            return s
 
-    err = False
-    if cmd != b'quit':
-        err = True
-        s = b'QUIT\r\n'
+        if cmd == b'quit':
+            s = b'221 Bye\r\n'
+        elif cmd == b'rset' or cmd == b'noop':
+            s = b'250 OK\r\n'
+        elif cmd.startswith(b'rcpt ') or cmd == b'data':
+            s = b'503 MAIL first.\r\n' # pipelined after a refused mail
+        elif cmd.startswith(b'bdat '):
+            n, last = bdat_args(cmd)
+            if n < 0 or not await smtp_skip(local_reader, n):
+                return b''
+            s = b'503 MAIL first.\r\n'
+        else:
+            return b''
         if verbose:
-            print2("!>>", s)
-    remote_writer.write(s)
-    await remote_writer.drain()
-    if remote_reader.at_eof():
-        return 1
-    s = await remote_reader.readline()
-    if verbose:
-        print2("<<<", s)
-    if err:
-        return 1
-    local_writer.write(s)
-    await local_writer.drain()
-    return 1
+            print2("<<!", s)
+        local_writer.write(s)
+        await local_writer.drain()
+        if cmd == b'quit':
+            return b''
 
 async def handle_pop(reader, writer):
-    await handle_common(reader, writer, pop_init)
+    await handle_common(reader, writer, pop_init, 'pop')
 
 async def handle_imap(reader, writer):
-    await handle_common(reader, writer, imap_init)
+    await handle_common(reader, writer, imap_init, 'imap')
 
 async def handle_smtp(reader, writer):
-    await handle_common(reader, writer, smtp_init)
+    await handle_common(reader, writer, smtp_init, 'smtp')
 
 async def start_server(handle, host, port, name):
-    server = await asyncio.start_server(handle, host, port)
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(
+        lambda: asyncio.StreamReaderProtocol(TimedReader(args.idle_timeout), handle), host, port)
     addr = server.sockets[0].getsockname()
     if args.verbose:
         print(f'Serving on {addr}: {name}')
@@ -1217,7 +3756,33 @@ async def wakeup():
         await asyncio.sleep(1)
 
 async def main(parent=None):
-    Conn.lock = -1
+    global tap, smtp_pool, hold_queue, outbox, imap_pool, pop_cache, metrics
+    global session_limit, account_limit, upstream_limit, account_upstream_limit
+    Conn.locks = {}
+    Params.pending = {}
+    metrics = Metrics()
+    tap = Tap()
+    session_limit = Limiter('sessions', args.max_sessions, args.queue)
+    account_limit = Limiter('account_sessions', args.max_account_sessions, args.queue)
+    upstream_limit = Limiter('upstream', args.max_upstream, args.queue)
+    account_upstream_limit = Limiter('account_upstream', args.max_account_upstream, args.queue)
+    if args.trace > 0:
+        trace_enable(args.trace)
+    smtp_pool = SmtpPool()
+    hold_queue = HoldQueue()
+    pop_cache = None
+    if args.pop and args.pop_cache > 0:
+        pop_cache = PopCache(os.path.join(params_main.store_dir, 'pop_cache'), args.pop_cache)
+        pop_cache.load()
+    imap_pool = None
+    if args.imap and args.imap_mux > 0:
+        imap_pool = ImapPool()
+    outbox = None
+    if args.smtp and args.spool:
+        outbox = Outbox(os.path.join(params_main.store_dir, 'spool'))
+    params_main.init_ssl()
+    for params in args.user_params.values():
+        params.init_ssl()
     loop = asyncio.get_running_loop()
     aws = []
     if args.smtp:
@@ -1232,20 +3797,37 @@ async def main(parent=None):
         imap_server = start_server(handle_imap, LOCAL_HOST, args.imap_port, 'imap')
         aws.append(imap_server)
 
-    if parent is None:
-        if sys.platform == 'win32':
-            aws.append(wakeup()) # or loop.create_task(wakeup())
-        await asyncio.gather(*aws)
-    else:
-        task = asyncio.gather(*aws)
+    if aws and args.metrics_port:
+        aws.append(start_server(handle_metrics, LOCAL_HOST, args.metrics_port, 'metrics'))
 
-        parent.loop = loop
-        parent.task = task
+    if aws and args.refresh_margin > 0:
+        aws.append(refresh_tokens())
+    if args.smtp and args.smtp_pool > 0:
+        aws.append(smtp_pool.keepalive())
+    if outbox:
+        aws.append(outbox.run())
+    if imap_pool:
+        aws.append(imap_pool.keepalive())
 
-        try:
-            await asyncio.gather(task)
-        except asyncio.CancelledError:
-            pass
+    if aws:
+        tap.start()
+    try:
+        if parent is None:
+            if sys.platform == 'win32':
+                aws.append(wakeup()) # or loop.create_task(wakeup())
+            await asyncio.gather(*aws)
+        else:
+            task = asyncio.gather(*aws)
+
+            parent.loop = loop
+            parent.task = task
+
+            try:
+                await asyncio.gather(task)
+            except asyncio.CancelledError:
+                pass
+    finally:
+        tap.stop()
 
 def task_cancel(loop, task):
     loop.call_soon_threadsafe(task.cancel)
@@ -1259,6 +3841,29 @@ def run_main(coro):
     if args.verbose: # debug
         print('=== Stop ===')
 
+# naive UTC, as creds.expiry of google-auth (utcnow() is deprecated)
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def expires_within(creds, sec):
+    if not sec or not creds.expiry:
+        return False
+    return creds.expiry - utcnow() < datetime.timedelta(seconds=sec)
+
+# renew cached auth-tokens before they expire
+async def refresh_tokens():
+    margin = args.refresh_margin
+    while True:
+        await asyncio.sleep(min(REFRESH_INTERVAL, margin / 2))
+        for _, creds, params, user in list(Params.creds_cache.values()):
+            if not creds.refresh_token or not expires_within(creds, margin):
+                continue
+            try:
+                await params.get_token_async(user, margin=margin, refresh_only=True)
+            except TokenError as ex:
+                if args.verbose: # debug
+                    print(ex)
+
 def parse_hostport(s, default_port=None):
     r = s.rsplit(":", 1)
     if len(r) == 1:
@@ -1271,6 +3876,10 @@ def parse_hostport(s, default_port=None):
     return (r[0], port)
 
 class Params:
+    executor = None
+    pending = {} # token file -> Future (single-flight)
+    creds_cache = {} # token file -> (mtime_ns, creds, params, user)
+    browser_lock = threading.Lock() # one interactive login at a time (the redirect port)
     def __init__(self, path=None):
         self.parent = None
         self.store_dir = ''
@@ -1331,24 +3940,60 @@ class Params:
         else:
             self.redirect_port = REDIRECT_PORT
 
+    def init_ssl(self):
+        for host in (self.remote_pop_host, self.remote_imap_host, self.remote_smtp_host):
+            get_ssl_context(host)
+
     def get_token_file(self, user):
         return os.path.join(self.store_dir, 'token-' + user + '.pickle')
 
-    def get_token(self, user, login_hint=None):
-        token_file = self.get_token_file(user)
-        creds = None
-        if os.path.exists(token_file):
+    def load_creds(self, token_file):
+        # unpickle only when the token file has changed since the last load
+        try:
+            mtime = os.stat(token_file).st_mtime_ns
+        except OSError:
+            Params.creds_cache.pop(token_file, None)
+            return None
+
+        entry = Params.creds_cache.get(token_file)
+        if entry and entry[0] == mtime:
+            creds = entry[1]
+        else:
             with open(token_file, 'rb') as token:
                 creds = pickle.load(token)
-                creds._client_id = self.client_id
-                creds._client_secret = self.client_secret
+        creds._client_id = self.client_id
+        creds._client_secret = self.client_secret
+        return creds
+
+    def save_creds(self, token_file, creds, user):
+        with open(token_file, 'wb') as token:
+            creds._client_id = '*'
+            creds._client_secret = '*'
+            if self.mode == MS_MODE:
+                if 'offline_access' in creds._scopes:
+                    creds._scopes.remove('offline_access')
+            pickle.dump(creds, token)
+        creds._client_id = self.client_id
+        creds._client_secret = self.client_secret
+        Params.creds_cache[token_file] = (os.stat(token_file).st_mtime_ns, creds, self, user)
+
+    # refresh_only: fail rather than start an interactive login
+    # timing: a list that gets the seconds a refresh took, if one was done
+    def get_token(self, user, login_hint=None, margin=0, refresh_only=False, timing=None):
+        token_file = self.get_token_file(user)
+        creds = self.load_creds(token_file)
 
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
+        if not creds or not creds.valid or (creds.refresh_token and expires_within(creds, margin)):
+            if creds and creds.refresh_token and (creds.expired or margin):
                 if args.verbose: # debug
                     now = time.strftime('%Y-%m-%d %H:%M:%S')
                     print(f'--- Refresh token [{now}] {user} ---')
+                start = time.monotonic()
                 creds.refresh(Request())
+                if timing is not None:
+                    timing.append(time.monotonic() - start)
+            elif refresh_only:
+                raise TokenError(f'No refresh token: {user}')
             else:
                 flow = InstalledAppFlow.from_client_config(
                     self.client_config, self.scopes)
@@ -1357,16 +4002,59 @@ class Params:
                     kwargs['login_hint'] = user
                 if self.redirect_port != REDIRECT_PORT:
                     kwargs['port'] = self.redirect_port
-                creds = flow.run_local_server(**kwargs)
-            with open(token_file, 'wb') as token:
-                creds._client_id = '*'
-                creds._client_secret = '*'
-                if self.mode == MS_MODE:
-                    if 'offline_access' in creds._scopes:
-                        creds._scopes.remove('offline_access')
-                pickle.dump(creds, token)
+                with Params.browser_lock:
+                    creds = flow.run_local_server(**kwargs)
+            self.save_creds(token_file, creds, user)
+        elif token_file not in Params.creds_cache or Params.creds_cache[token_file][1] is not creds:
+            Params.creds_cache[token_file] = (os.stat(token_file).st_mtime_ns, creds, self, user)
         return creds.token
 
+    async def get_token_async(self, user, login_hint=None, margin=0, refresh_only=False):
+        # run get_token() off the event loop; concurrent callers for the same
+        # token file share one call
+        key = self.get_token_file(user)
+        if not margin:
+            entry = Params.creds_cache.get(key)
+            if entry and entry[1].valid:
+                try:
+                    if os.stat(key).st_mtime_ns == entry[0]:
+                        return entry[1].token
+                except OSError:
+                    pass
+
+        fut = Params.pending.get(key)
+        if fut is None:
+            if Params.executor is None:
+                Params.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=TOKEN_WORKERS, thread_name_prefix=PROG + '-token')
+            loop = asyncio.get_running_loop()
+            timing = []
+            fut = loop.run_in_executor(Params.executor, self.get_token, user, login_hint, margin,
+                refresh_only, timing)
+            Params.pending[key] = fut
+
+            def done(f):
+                if Params.pending.get(key) is f:
+                    del Params.pending[key]
+                for t in timing: # not the token file reads nor browser logins
+                    metrics.observe('o2pop_token_seconds', t)
+                if f.cancelled() or f.exception():
+                    metrics.inc('o2pop_token_failures_total')
+            fut.add_done_callback(done)
+
+        timeout = args.token_timeout if args.token_timeout > 0 else None # 0: none
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), timeout)
+        except asyncio.TimeoutError:
+            metrics.inc('o2pop_token_timeouts_total')
+            raise TokenError(f'Token timeout: {user} ({args.token_timeout}s)')
+        except Exception as ex:
+            raise TokenError(f'Token error: {user} ({type(ex).__name__}: {ex})') from ex
+
+    def get_expiry(self, user):
+        entry = Params.creds_cache.get(self.get_token_file(user))
+        return entry and entry[1].expiry
+
     def info(self):
         config = self.client_config['installed']
         s = (
@@ -1424,6 +4112,59 @@ parser.add_argument("--pop", dest='pop_port', metavar='PORT', nargs='?', type=in
 parser.add_argument("--imap", dest='imap_port', metavar='PORT', nargs='?', type=int,
     const=LOCAL_IMAP_PORT, help="enable imap proxy (default port: %(const)s)", )
 parser.add_argument("--ca_file", help="CA file")
+parser.add_argument("--token_timeout", metavar='SEC', type=float, default=TOKEN_TIMEOUT,
+    help="timeout for getting auth-token (default: %(default)s, 0: none)")
+parser.add_argument("--connect_timeout", metavar='SEC', type=float, default=CONNECT_TIMEOUT,
+    help="timeout for connecting to the server, including TLS handshake\n(default: %(default)s, 0: none)")
+parser.add_argument("--login_timeout", metavar='SEC', type=float, default=LOGIN_TIMEOUT,
+    help="close a client connection not authenticated within this time\n(default: %(default)s, 0: none)")
+parser.add_argument("--server_timeout", metavar='SEC', type=float, default=SERVER_TIMEOUT,
+    help="timeout for a server reply or for it to read a write\n(default: %(default)s, 0: none)")
+parser.add_argument("--idle_timeout", metavar='SEC', type=float, default=IDLE_TIMEOUT,
+    help="close a session idle (or not reading) for this time\n(default: %(default)s, 0: none)")
+parser.add_argument("--buffer_size", metavar='BYTES', type=int, default=BUFFER_SIZE,
+    help="relay read size (default: %(default)s)")
+parser.add_argument("--spool_size", metavar='BYTES', type=int, default=SPOOL_SIZE,
+    help="size of a mail kept in memory before spooling to a temp file\n(default: %(default)s)")
+parser.add_argument("--smtp_size", metavar='BYTES', type=int, default=SMTP_SIZE,
+    help="maximum size of a mail accepted by the smtp server\n(default: %(default)s, 0: no limit)")
+parser.add_argument("--spool", help="queue mails in STORE_DIR/spool and send them in the background",
+    action="store_true")
+parser.add_argument("--spool_concurrency", metavar='N', type=int, default=2,
+    help="deliveries from the spool at a time per account\n(default: %(default)s)")
+parser.add_argument("--spool_list", help="show mails in the spool and exit", action="store_true")
+parser.add_argument("--pop_cache", metavar='BYTES', type=int, default=0,
+    help="keep retrieved pop messages in STORE_DIR/pop_cache up to BYTES\n(default: %(default)s)")
+parser.add_argument("--pop_engine", help="handle pop commands after login: pipelining, prefetching\nand latency stats",
+    action="store_true")
+parser.add_argument("--imap_mux", metavar='N', type=int, default=0,
+    help="share up to N imap connections per account among local clients;\nthey must use UID FETCH/SEARCH/STORE/COPY/MOVE (sequence numbers\nare refused)\n(default: %(default)s, 0: one connection per client)")
+parser.add_argument("--imap_compress", help="compress the imap connections to the server (COMPRESS=DEFLATE)",
+    action="store_true")
+parser.add_argument("--imap_idle_poll", metavar='SEC', type=float, default=IMAP_IDLE_POLL,
+    help="check for new mails this often while a client is in IDLE\n(--imap_mux, default: %(default)s)")
+parser.add_argument("--hold_timeout", metavar='SEC', type=float, default=HOLD_TIMEOUT,
+    help="send a mail held by the send delay after SEC if not confirmed\n(default: %(default)s)")
+parser.add_argument("--smtp_pool", metavar='N', type=int, default=0,
+    help="keep up to N authenticated smtp connections per account\n(default: %(default)s)")
+parser.add_argument("--max_sessions", metavar='N', type=int, default=0,
+    help="local sessions at a time (default: %(default)s, 0: no limit)")
+parser.add_argument("--max_account_sessions", metavar='N', type=int, default=0,
+    help="local sessions at a time per account (default: %(default)s, 0: no limit)")
+parser.add_argument("--max_upstream", metavar='N', type=int, default=0,
+    help="server connections at a time (default: %(default)s, 0: no limit)")
+parser.add_argument("--max_account_upstream", metavar='N', type=int, default=0,
+    help="server connections at a time per account (default: %(default)s, 0: no limit)")
+parser.add_argument("--queue", metavar='N', type=int, default=16,
+    help="sessions waiting for each of the limits above; more are rejected\n(default: %(default)s)")
+parser.add_argument("--queue_timeout", metavar='SEC', type=float, default=30,
+    help="reject a session after waiting this long for a limit\n(default: %(default)s)")
+parser.add_argument("--metrics_port", metavar='PORT', type=int, default=0,
+    help="serve counters and latencies on http://127.0.0.1:PORT/metrics\n(default: %(default)s, 0: disable)")
+parser.add_argument("--trace", metavar='N', type=int, default=0,
+    help="keep phase timings of the last N sessions (GET /trace on --metrics_port)\n(default: %(default)s, 0: disable)")
+parser.add_argument("--refresh_margin", metavar='SEC', type=float, default=REFRESH_MARGIN,
+    help="refresh auth-tokens this long before they expire\n(default: %(default)s, 0: disable)")
 parser.add_argument("-f", "--secret_file", help="client secret file", dest='client_secret_file', metavar='SECRET_FILE')
 parser.add_argument("-m", nargs='+', help="mapping email and client secret file\n(MAP syntax: EMAIL[,EMAIL2 ...]:SECRET_FILE)",
     dest='map_list', metavar='MAP')
@@ -1463,6 +4204,9 @@ if __name__ == '__main__':
     if args.params:
         print_params()
         sys.exit()
+    if args.spool_list:
+        print_spool(params_main.store_dir)
+        sys.exit()
     if not (args.smtp or args.pop or args.imap):
         parser.print_help()
         sys.exit()
@@ -38,17 +38,18 @@ DEFAULT_BLOCK_LIST = '@gmai.com'
 class BlockSmtp:
     def __init__(self, parent):
         self.parent = parent
-        self.cancel = False
-        self.task = None
 
-    def run(self):
-        evt = self.parent.block_smtp_event()
+    # called from the o2pop thread; mail: o2pop.HeldMail
+    def run(self, mail):
+        evt = self.parent.block_smtp_event(mail=mail)
         wx.PostEvent(self.parent, evt)
 
+# modeless: one dialog per held mail
 class SendingDialog(wx.Dialog):
-    def __init__(self, parent, *args, **kw):
+    def __init__(self, parent, mail, *args, **kw):
         # self.parent = parent
         super().__init__(*args, **kw)
+        self.mail = mail
 
         self.SetIcon(parent.icon)
         self.Bind(wx.EVT_CLOSE, self.on_close)
@@ -76,7 +77,7 @@ class SendingDialog(wx.Dialog):
 
         text21 = wx.StaticText(self, label=_("Envelope-From:"), style=wx.ALIGN_RIGHT)
         hbox2.Add(text21)
-        s = parent.env_from
+        s = mail.env_from
         text22 = wx.StaticText(self, label=s)
         text22.SetForegroundColour('#0033ff')
         hbox2.Add(text22, flag=wx.LEFT, border=5)
@@ -87,7 +88,7 @@ class SendingDialog(wx.Dialog):
         hbox3 = wx.BoxSizer(wx.HORIZONTAL)
         text31 = wx.StaticText(self, label=_("To+Cc+Bcc:"), size=text21.GetSize(), style=wx.ALIGN_RIGHT)
         hbox3.Add(text31)
-        s = str(parent.rcpt_count)
+        s = str(mail.rcpt_count)
         text32 = wx.StaticText(self, label=s)
         text32.SetForegroundColour('#0033ff')
         hbox3.Add(text32, flag=wx.LEFT, border=5)
@@ -98,34 +99,53 @@ class SendingDialog(wx.Dialog):
 
         line = wx.StaticLine(self)
         main_sizer.Add(line, flag=wx.EXPAND|wx.ALL, border=10)
+        hbox4 = wx.BoxSizer(wx.HORIZONTAL)
+        button_send = wx.Button(self, wx.ID_OK, label=_("Send now"))
+        hbox4.Add(button_send)
         button_cancel = wx.Button(self, wx.ID_CANCEL, label=_("Cancel"))
-        main_sizer.Add(button_cancel, flag=wx.LEFT|wx.RIGHT|wx.BOTTOM|wx.ALIGN_RIGHT, border=15)
+        hbox4.Add(button_cancel, flag=wx.LEFT, border=5)
+        main_sizer.Add(hbox4, flag=wx.LEFT|wx.RIGHT|wx.BOTTOM|wx.ALIGN_RIGHT, border=15)
+        self.Bind(wx.EVT_BUTTON, self.on_send, id=wx.ID_OK)
+        self.Bind(wx.EVT_BUTTON, self.on_cancel, id=wx.ID_CANCEL)
         self.SetSizerAndFit(main_sizer)
         self.Centre()
 
-    def __del__(self):
+    def finish(self, send):
         self.timer.Stop()
+        if send:
+            o2pop.hold_queue.confirm(self.mail.id)
+        else:
+            o2pop.hold_queue.cancel(self.mail.id)
+        self.Destroy()
 
     def on_timer(self, evt):
         self.count = self.count + 1
         if self.count > self.delay:
-            self.EndModal(wx.ID_CLOSE)
+            self.finish(True)
             return
         self.gauge.SetValue(self.count)
 
+    def on_send(self, evt):
+        self.finish(True)
+
+    def on_cancel(self, evt):
+        self.finish(False)
+
     def on_close(self, evt):
-        self.EndModal(wx.ID_CLOSE)
+        self.finish(True)
 
-def parse_block_list(block_list):
+# also used for the To/Cc exclude list
+# parsed: the previous result, reused while the text is unchanged
+def parse_block_list(block_list, parsed=None):
     if not block_list:
         return None
 
-    r = []
-    for t in block_list.encode().translate(bytes.maketrans(b',\r\n', b'   ')).lower().split():
-        if t.find(b'@') > 0 and (not t.startswith(b'.')):
-            r.append((t, True))
-        else:
-            r.append((t, False))
+    t = block_list.encode()
+    if parsed and parsed.text == t:
+        return parsed
+    r = o2pop.AddressMatcher(t)
+    if not r:
+        return None
     return r
 
 class MainMenu(wx.adv.TaskBarIcon):
@@ -149,8 +169,6 @@ class MainMenu(wx.adv.TaskBarIcon):
         else:
             self.pf_windows = False
 
-        self.rcpt_count = 0
-        self.env_from = ''
   
         self.args = o2pop.args
         self.params = o2pop.params_main
@@ -183,6 +201,7 @@ class MainMenu(wx.adv.TaskBarIcon):
 
             self.to_cc_max = 10
             self.to_cc_exclude = ''
+            self.to_cc_exclude_parsed = None
             self.send_delay = 5
             self.remove_header = False
             self.change_env_from = False
@@ -207,6 +226,7 @@ class MainMenu(wx.adv.TaskBarIcon):
 
             self.to_cc_max = ini_data['to_cc_max']
             self.to_cc_exclude = ini_data['to_cc_exclude']
+            self.to_cc_exclude_parsed = None
             self.send_delay = ini_data['send_delay']
             self.remove_header = ini_data['remove_header']
             self.change_env_from = ini_data.get('change_env_from', False) # new
@@ -267,7 +287,8 @@ class MainMenu(wx.adv.TaskBarIcon):
         self.args.imap = self.imap
         self.args.imap_port = self.imap_port
 
-        self.block_list_parsed = parse_block_list(self.block_list)
+        self.block_list_parsed = parse_block_list(self.block_list, self.block_list_parsed)
+        self.to_cc_exclude_parsed = parse_block_list(self.to_cc_exclude, self.to_cc_exclude_parsed)
 
         self.params.reset(self)
         self.params_info = self.params.info()
@@ -299,13 +320,9 @@ class MainMenu(wx.adv.TaskBarIcon):
         self.params_sub_info = params_sub_info
 
     def on_delay(self, e):
-        dlg = SendingDialog(self, None, title=_("Delay Sending"), style=wx.DEFAULT_DIALOG_STYLE|wx.STAY_ON_TOP)
-        result = dlg.ShowModal()
-        dlg.Destroy()
-
-        if result == wx.ID_CANCEL:
-            self.block_smtp.cancel = True
-        self.task_cancel(self.block_smtp.task)
+        title = _("Delay Sending") + f' #{e.mail.id}'
+        dlg = SendingDialog(self, e.mail, None, title=title, style=wx.DEFAULT_DIALOG_STYLE|wx.STAY_ON_TOP)
+        dlg.Show()
 
     def CreatePopupMenu(self):
         menu = wx.Menu()
@@ -0,0 +1,490 @@
+#
+# test_o2pop.py (tests for o2pop)
+#
+# Copyright (c) 2020-2022 MURATA Yasuhisa
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+#
+#   python -m unittest discover -s tests
+#
+# Skipped without the packages o2pop needs (google-auth-oauthlib), and
+# before Python 3.8 (IsolatedAsyncioTestCase).
+#
+
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+if sys.version_info < (3, 8):
+    raise unittest.SkipTest('IsolatedAsyncioTestCase needs Python 3.8')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+argv = sys.argv
+sys.argv = ['o2pop']
+try:
+    import o2pop
+except ImportError as ex:
+    raise unittest.SkipTest(f'o2pop not importable: {ex}')
+finally:
+    sys.argv = argv
+
+# the globals main() would make
+def setup_globals():
+    o2pop.metrics = o2pop.Metrics()
+    o2pop.session_limit = o2pop.Limiter('sessions', 0, 0)
+    o2pop.account_limit = o2pop.Limiter('account_sessions', 0, 0)
+    o2pop.upstream_limit = o2pop.Limiter('upstream', 0, 0)
+    o2pop.account_upstream_limit = o2pop.Limiter('account_upstream', 0, 0)
+
+class Creds:
+    token = 'token'
+
+# InstalledAppFlow stand-in: counts the logins in progress
+class Flow:
+    active = 0
+    most = 0
+    @classmethod
+    def from_client_config(cls, config, scopes):
+        return cls()
+
+    def run_local_server(self, **kwargs):
+        Flow.active += 1
+        Flow.most = max(Flow.most, Flow.active)
+        time.sleep(0.05)
+        Flow.active -= 1
+        return Creds()
+
+class ParamsTest(unittest.TestCase):
+    def setUp(self):
+        saved = o2pop.InstalledAppFlow
+        o2pop.InstalledAppFlow = Flow
+        self.addCleanup(setattr, o2pop, 'InstalledAppFlow', saved)
+        Flow.most = 0
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        self.params = params = o2pop.Params.__new__(o2pop.Params)
+        params.parent = None
+        params.store_dir = d.name
+        params.client_config = params.scopes = params.client_id = params.client_secret = None
+        params.mode = None
+        params.redirect_port = o2pop.REDIRECT_PORT
+
+    def test_one_browser_login_at_a_time(self):
+        threads = [threading.Thread(target=self.params.get_token, args=(f'user{i}@example.com',)) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(Flow.most, 1)
+
+    def test_refresh_only(self):
+        with self.assertRaises(o2pop.TokenError):
+            self.params.get_token('user@example.com', margin=60, refresh_only=True)
+        self.assertEqual(Flow.most, 0)
+
+    def test_no_token_timeout(self):
+        setup_globals()
+        saved = o2pop.args.token_timeout
+        self.addCleanup(setattr, o2pop.args, 'token_timeout', saved)
+        o2pop.args.token_timeout = 0 # none, not an immediate timeout
+        token = asyncio.run(self.params.get_token_async('user@example.com'))
+        self.assertEqual(token, 'token')
+        # a browser login is not a refresh
+        self.assertNotIn('o2pop_token_seconds', o2pop.metrics.render())
+
+class TraceTest(unittest.TestCase):
+    def test_disable(self):
+        saved = o2pop.args.trace
+        self.addCleanup(setattr, o2pop.args, 'trace', saved)
+        o2pop.args.trace = 0
+        o2pop.trace_enable() # by the Monitor
+        self.assertIsNotNone(o2pop.traces)
+        o2pop.trace_disable()
+        self.assertIsNone(o2pop.traces)
+
+        o2pop.args.trace = 10 # --trace
+        o2pop.trace_enable(10)
+        o2pop.trace_disable()
+        self.assertIsNotNone(o2pop.traces)
+        o2pop.traces = None
+
+    def test_disable_mid_session(self):
+        saved = o2pop.args.trace
+        self.addCleanup(setattr, o2pop.args, 'trace', saved)
+        o2pop.args.trace = 0
+        o2pop.trace_enable()
+        kept = o2pop.traces
+        conn = o2pop.Conn()
+        conn.trace_begin('pop')
+        o2pop.trace_disable() # the Monitor closed
+        conn.trace_end()
+        self.assertEqual(len(kept), 1)
+        self.assertIsNone(o2pop.traces)
+
+class TapTest(unittest.TestCase):
+    def test_drops_when_full(self):
+        setup_globals()
+        tap = o2pop.Tap()
+        for i in range(o2pop.TAP_QUEUE_SIZE + 3):
+            tap.put('<<<[0]', b'line\r\n')
+        self.assertEqual(tap.dropped_total[0], 3)
+        self.assertIn('o2pop_tap_dropped_total 3', o2pop.metrics.render())
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            tap.start()
+            thread = tap.thread
+            tap.put('<<<[0]', b'last\r\n')
+            tap.stop()
+            thread.join(5)
+        self.assertIn("<<<[0] --- 3 chunk(s) dropped ---\n<<<[0] b'last\\r\\n'\n", out.getvalue())
+
+class TimedDrainTest(unittest.IsolatedAsyncioTestCase):
+    async def test_peer_not_reading(self):
+        done = asyncio.Event()
+        async def handle(reader, writer):
+            await done.wait()
+            writer.close()
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+        writer.write(b'x' * 100)
+        await o2pop.timed_drain(writer, 0.2)
+        t = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            while True:
+                writer.write(b'x' * 1024 * 1024)
+                await o2pop.timed_drain(writer, 0.2)
+        self.assertLess(time.monotonic() - t, 5)
+        writer.transport.abort()
+        done.set()
+        server.close()
+        await server.wait_closed()
+
+class SmtpPoolTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        setup_globals()
+        self.saved = o2pop.SMTP_NOOP_INTERVAL, o2pop.args.server_timeout
+        o2pop.SMTP_NOOP_INTERVAL = 0.05
+        o2pop.args.server_timeout = 0.2
+
+    async def asyncTearDown(self):
+        o2pop.SMTP_NOOP_INTERVAL, o2pop.args.server_timeout = self.saved
+
+    async def test_keepalive_server_stops_replying(self):
+        # accepts the connection, then never answers
+        async def handle(reader, writer):
+            await reader.read()
+            writer.close()
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+
+        pool = o2pop.SmtpPool()
+        reader, writer = await o2pop.open_upstream('127.0.0.1', port, None, 'a@example.com')
+        session = o2pop.SmtpSession('key', reader, writer, 0)
+        session.checked = time.monotonic() - 1
+        pool.idle['key'] = [session]
+
+        task = asyncio.create_task(pool.keepalive())
+        await asyncio.sleep(0.6)
+        self.assertFalse(task.done()) # the pool survives the dead server
+        self.assertEqual(pool.idle['key'], [])
+        self.assertTrue(writer.is_closing())
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        server.close()
+        await server.wait_closed()
+
+class OutboxTest(unittest.IsolatedAsyncioTestCase):
+    async def test_deliver_error(self):
+        async def broken(meta, path):
+            raise ValueError('broken')
+        saved = o2pop.spool_deliver
+        o2pop.spool_deliver = broken
+        self.addCleanup(setattr, o2pop, 'spool_deliver', saved)
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        outbox = o2pop.Outbox(d.name)
+        meta = {'id': 'm1', 'user': 'a@example.com', 'created': time.time(), 'attempts': 0,
+            'next_try': 0, 'error': '', 'failed': False}
+        outbox.queue['m1'] = meta
+        outbox.busy.add('m1')
+        outbox.accounts['a@example.com'] = 1
+        with contextlib.redirect_stdout(io.StringIO()):
+            await outbox.deliver(meta)
+        self.assertEqual(outbox.busy, set())
+        self.assertEqual(meta['attempts'], 1)
+        self.assertEqual(meta['error'], 'ValueError: broken')
+        self.assertGreater(meta['next_try'], time.time() + o2pop.SPOOL_RETRY / 2)
+        self.assertIn('m1', outbox.queue)
+        self.assertTrue(os.path.exists(os.path.join(d.name, 'm1.json')))
+
+class PopCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        self.cache = o2pop.PopCache(d.name, 250)
+        self.cache.load()
+
+    def put(self, uidl, data):
+        with self.cache.create() as f:
+            f.write(data)
+        self.cache.add(b'a@example.com', uidl, f.name, hashlib.sha256(data).hexdigest(), len(data))
+        return os.path.join(self.cache.path, hashlib.sha256(data).hexdigest())
+
+    async def saved(self):
+        while self.cache.saving:
+            await self.cache.saving
+        with open(os.path.join(self.cache.path, 'index.json')) as f:
+            return json.load(f)
+
+    async def test_check_once(self):
+        path = self.put(b'u1', b'x' * 100)
+        with open(path, 'r+b') as f:
+            f.write(b'y') # same size: not seen until the cache is loaded again
+        m = await self.cache.open(b'a@example.com', b'u1')
+        self.assertEqual(m[:2], b'yx')
+        m.close()
+
+        await self.saved()
+        cache = o2pop.PopCache(self.cache.path, 250)
+        cache.load()
+        self.assertIsNone(await cache.open(b'a@example.com', b'u1'))
+        self.assertEqual(cache.index, {})
+
+    async def test_size_check(self):
+        path = self.put(b'u1', b'x' * 100)
+        with open(path, 'ab') as f:
+            f.write(b'y')
+        self.assertIsNone(await self.cache.open(b'a@example.com', b'u1'))
+
+    async def test_evict(self):
+        for i in range(5):
+            self.put(b'u%d' % i, b'%d' % i * 100)
+            self.cache.blobs[hashlib.sha256(b'%d' % i * 100).hexdigest()][1] = i
+        self.assertEqual(self.cache.total, 200)
+        self.assertEqual(sorted(await self.saved()), ['a@example.com u3', 'a@example.com u4'])
+
+    async def test_drop_open_blob(self):
+        path = self.put(b'u1', b'x' * 100)
+        remove = os.remove
+        def locked(p):
+            if p == path:
+                raise PermissionError(p)
+            remove(p)
+        o2pop.os.remove = locked
+        try:
+            self.cache.drop(os.path.basename(path))
+        finally:
+            o2pop.os.remove = remove
+        self.assertIsNone(await self.cache.open(b'a@example.com', b'u1'))
+        self.assertTrue(os.path.exists(path))
+        self.put(b'u2', b'z' * 10) # retries the removal
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.cache.stale, set())
+
+class PopSessionTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        setup_globals()
+        self.saved = o2pop.args.pop_engine, o2pop.POP_PREFETCH_SIZE
+        o2pop.args.pop_engine = True
+        o2pop.POP_PREFETCH_SIZE = 100
+
+    async def asyncTearDown(self):
+        o2pop.args.pop_engine, o2pop.POP_PREFETCH_SIZE = self.saved
+
+    # the commands the server got for the client's
+    async def session(self, cmds):
+        sizes = [10, 10, 10, 10, 1000]
+        log = []
+        async def handle(reader, writer):
+            while True:
+                s = await reader.readline()
+                if not s:
+                    break
+                log.append(s.strip())
+                cmd, *arg = s.split()
+                if cmd == b'CAPA':
+                    writer.write(b'+OK\r\nPIPELINING\r\n.\r\n')
+                elif cmd == b'LIST':
+                    writer.write(b'+OK\r\n' + b''.join(b'%d %d\r\n' % (i + 1, n) for i, n in enumerate(sizes)) + b'.\r\n')
+                elif cmd == b'RETR':
+                    writer.write(b'+OK\r\nmessage %b\r\n.\r\n' % arg[0])
+                elif cmd == b'STAT':
+                    writer.write(b'+OK %d 1040\r\n' % len(sizes))
+                else:
+                    writer.write(b'+OK\r\n')
+                await writer.drain()
+            writer.close()
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+
+        sessions = []
+        async def local(reader, writer):
+            remote = o2pop.Conn()
+            remote.reader, remote.writer = await o2pop.open_upstream('127.0.0.1', port, None, 'a@example.com')
+            session = o2pop.PopSession(reader, writer, remote, b'a@example.com')
+            sessions.append(session)
+            await session.run()
+            remote.writer.close()
+            writer.close()
+        proxy = await asyncio.start_server(local, '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', proxy.sockets[0].getsockname()[1])
+        for s in cmds:
+            writer.write(s + b'\r\n')
+            if s.startswith((b'RETR', b'LIST')):
+                self.assertEqual((await reader.readuntil(b'\r\n.\r\n'))[:5], b'+OK\r\n')
+                if s.startswith(b'RETR'):
+                    await asyncio.sleep(0.05) # prefetched meanwhile
+            else:
+                self.assertTrue((await reader.readline()).startswith(b'+OK'))
+        self.assertEqual(await reader.read(), b'')
+        writer.close()
+        for s in (server, proxy):
+            s.close()
+            await s.wait_closed()
+        return log[1:], sessions[0].hits # after CAPA
+
+    async def test_sequential(self):
+        log, hits = await self.session([b'LIST', b'RETR 1', b'RETR 2', b'DELE 2', b'RETR 3', b'QUIT'])
+        self.assertEqual(log, [b'LIST', b'RETR 1', b'RETR 2', b'RETR 3', b'DELE 2', b'RETR 4', b'QUIT'])
+        self.assertEqual(hits, 1)
+
+    async def test_relay_bytes(self):
+        await self.session([b'RETR 1', b'QUIT'])
+        out = o2pop.metrics.render()
+        self.assertIn('o2pop_relay_bytes_total{direction="up",proto="pop"} 14', out)
+        self.assertIn('o2pop_relay_bytes_total{direction="down",proto="pop"} 24', out)
+
+    async def test_not_sequential(self):
+        log, hits = await self.session([b'LIST', b'RETR 1', b'RETR 3', b'QUIT'])
+        self.assertEqual(log, [b'LIST', b'RETR 1', b'RETR 3', b'QUIT'])
+
+    async def test_abandoned(self):
+        log, hits = await self.session([b'LIST', b'RETR 1', b'RETR 2', b'STAT', b'RETR 3', b'QUIT'])
+        self.assertEqual(log, [b'LIST', b'RETR 1', b'RETR 2', b'RETR 3', b'STAT', b'RETR 3', b'RETR 4', b'QUIT'])
+        self.assertEqual(hits, 0)
+
+    async def test_size_cap(self):
+        log, hits = await self.session([b'LIST', b'RETR 3', b'RETR 4', b'QUIT'])
+        self.assertEqual(log, [b'LIST', b'RETR 3', b'RETR 4', b'QUIT'])
+
+    async def test_no_list(self):
+        log, hits = await self.session([b'RETR 1', b'RETR 2', b'QUIT'])
+        self.assertEqual(log, [b'RETR 1', b'RETR 2', b'QUIT'])
+
+class ImapPoolTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        setup_globals()
+        self.saved = o2pop.args.imap_mux, o2pop.args.queue_timeout
+        o2pop.args.imap_mux = 1
+        o2pop.args.queue_timeout = 0.2
+
+    async def asyncTearDown(self):
+        o2pop.args.imap_mux, o2pop.args.queue_timeout = self.saved
+
+    async def test_long_response_line(self):
+        line = b'* SEARCH ' + b' '.join(b'%d' % i for i in range(1, 30001)) + b'\r\n'
+        async def handle(reader, writer):
+            s = await reader.readline()
+            writer.write(line + s.split()[0] + b' OK done\r\n')
+            await writer.drain()
+            await reader.read()
+            writer.close()
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+
+        up = o2pop.ImapUpstream('key')
+        up.remote.reader, up.remote.writer = await o2pop.open_upstream(
+            '127.0.0.1', port, None, 'a@example.com')
+        lines = []
+        s = await up.command([b'UID SEARCH ALL\r\n'], None, None, lines)
+        self.assertEqual(s, b'M1 OK done\r\n')
+        self.assertEqual(lines, [line])
+        up.close()
+        server.close()
+        await server.wait_closed()
+
+    async def test_lease_deadline(self):
+        pool = o2pop.ImapPool()
+        up = o2pop.ImapUpstream('key') # busy
+        pool.conns['key'] = [up]
+        t = time.monotonic()
+        self.assertIsNone(await pool.lease('key', None, None, b'a@example.com'))
+        self.assertLess(time.monotonic() - t, 1)
+
+    async def test_wakeup_of_cancelled_waiter(self):
+        pool = o2pop.ImapPool()
+        up = o2pop.ImapUpstream('key')
+        pool.conns['key'] = [up]
+        first = asyncio.create_task(pool.lease('key', None, None, b'a@example.com'))
+        second = asyncio.create_task(pool.lease('key', None, None, b'a@example.com'))
+        await asyncio.sleep(0.01)
+        pool.release(up) # wakes the first waiter, which is cancelled
+        first.cancel()
+        self.assertIs(await second, up)
+
+    async def test_mux_sequence_numbers(self):
+        # upstream: every command succeeds
+        async def handle(reader, writer):
+            while True:
+                s = await reader.readline()
+                if not s:
+                    break
+                writer.write(s.split()[0] + b' OK done\r\n')
+                await writer.drain()
+            writer.close()
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        saved = o2pop.imap_pool, o2pop.args.imap_idle_poll
+        o2pop.imap_pool = pool = o2pop.ImapPool()
+        o2pop.args.imap_idle_poll = 0.05
+        up = o2pop.ImapUpstream('key')
+        up.remote.reader, up.remote.writer = await o2pop.open_upstream(
+            '127.0.0.1', port, None, 'a@example.com')
+        up.busy = False
+        pool.conns['key'] = [up]
+
+        # the local client over a socket pair
+        sessions = []
+        async def local(reader, writer):
+            remote = o2pop.Conn()
+            params = o2pop.Params.__new__(o2pop.Params)
+            params.get_token_file = lambda user: 'key'
+            sessions.append(await o2pop.imap_mux(reader, writer, remote, params, b'a@example.com', b'A0'))
+            writer.close()
+        proxy = await asyncio.start_server(local, '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', proxy.sockets[0].getsockname()[1])
+        self.assertEqual(await reader.readline(), b'A0 OK LOGIN completed\r\n')
+        async def command(s):
+            writer.write(s)
+            return await reader.readline()
+        self.assertTrue((await command(b'A1 SELECT INBOX\r\n')).startswith(b'A1 OK'))
+        self.assertTrue((await command(b'A2 FETCH 1 FLAGS\r\n')).startswith(b'A2 NO [CANNOT]'))
+        self.assertTrue((await command(b'A3 UID FETCH 1 FLAGS\r\n')).startswith(b'A3 OK'))
+        self.assertEqual(await command(b'A4 IDLE\r\n'), b'+ idling\r\n')
+        await asyncio.sleep(0.2) # polls
+        self.assertEqual(await command(b'DONE\r\n'), b'A4 OK IDLE terminated\r\n')
+        self.assertTrue((await command(b'A5 LOGOUT\r\n')).startswith(b'* BYE'))
+        await reader.read()
+        self.assertEqual(sessions, [1])
+        self.assertFalse(up.busy)
+
+        writer.close()
+        up.close()
+        o2pop.imap_pool, o2pop.args.imap_idle_poll = saved
+        for s in (server, proxy):
+            s.close()
+            await s.wait_closed()
+
+if __name__ == '__main__':
+    unittest.main()
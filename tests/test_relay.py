@@ -0,0 +1,140 @@
+#
+# test_relay.py (tests for the relay of o2pop)
+#
+# Copyright (c) 2020-2022 MURATA Yasuhisa
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+#
+#   python -m unittest discover -s tests
+#
+# Runs on Python 3.7, the oldest asyncio o2pop works with.
+#
+
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+argv = sys.argv
+sys.argv = ['o2pop']
+try:
+    import o2pop
+except ImportError as ex:
+    raise unittest.SkipTest(f'o2pop not importable: {ex}')
+finally:
+    sys.argv = argv
+
+# a StreamReader without the internals of asyncio's
+class PlainReader:
+    def __init__(self, reader):
+        self.reader = reader
+
+    async def read(self, n=-1):
+        return await self.reader.read(n)
+
+# client -> proxy (reads the first line, then relays) -> echo server
+async def run_relay(wrap):
+    async def echo(reader, writer):
+        while True:
+            data = await reader.read(1024)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+    server = await asyncio.start_server(echo, '127.0.0.1', 0)
+
+    async def proxy(reader, writer):
+        await reader.readline() # login phase
+        remote_reader, remote_writer = await asyncio.open_connection(
+            '127.0.0.1', server.sockets[0].getsockname()[1])
+        await o2pop.relay(wrap(reader), writer, wrap(remote_reader), remote_writer, 0, 'test')
+    proxy_server = await asyncio.start_server(proxy, '127.0.0.1', 0)
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', proxy_server.sockets[0].getsockname()[1])
+    writer.write(b'LOGIN\r\nbuffered\r\n') # the second line waits in the StreamReader
+    await asyncio.sleep(0.1)
+    writer.write(b'relayed\r\n')
+    data = b''
+    while len(data) < 19:
+        s = await asyncio.wait_for(reader.read(1024), 5)
+        if not s:
+            break
+        data += s
+    writer.close()
+    for s in (server, proxy_server):
+        s.close()
+        await s.wait_closed()
+    return data
+
+# client -> proxy -> silent server, both idle; the sides the proxy aborted
+async def run_idle(relay_func):
+    async def silent(reader, writer):
+        await reader.read()
+        writer.close()
+    server = await asyncio.start_server(silent, '127.0.0.1', 0)
+
+    aborted = []
+    def recording(transport, side):
+        abort = transport.abort
+        def wrapper():
+            aborted.append(side)
+            abort()
+        transport.abort = wrapper
+
+    done = asyncio.get_running_loop().create_future()
+    async def proxy(reader, writer):
+        remote_reader, remote_writer = await asyncio.open_connection(
+            '127.0.0.1', server.sockets[0].getsockname()[1])
+        recording(writer.transport, 'local')
+        recording(remote_writer.transport, 'remote')
+        try:
+            await relay_func(reader, writer, remote_reader, remote_writer, 0, 'test')
+        except Exception:
+            pass
+        done.set_result(None)
+    # the reader of the local connection as in o2pop's main()
+    loop = asyncio.get_running_loop()
+    proxy_server = await loop.create_server(lambda: asyncio.StreamReaderProtocol(
+        o2pop.TimedReader(o2pop.args.idle_timeout), proxy), '127.0.0.1', 0)
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', proxy_server.sockets[0].getsockname()[1])
+    await asyncio.wait_for(done, 5)
+    writer.close()
+    for s in (server, proxy_server):
+        s.close()
+        await s.wait_closed()
+    return sorted(set(aborted))
+
+class RelayTest(unittest.TestCase):
+    def setUp(self):
+        o2pop.metrics = o2pop.Metrics()
+
+    def test_handoff(self):
+        self.assertEqual(asyncio.run(run_relay(lambda reader: reader)), b'buffered\r\nrelayed\r\n')
+
+    def test_no_internals(self):
+        self.assertEqual(asyncio.run(run_relay(PlainReader)), b'buffered\r\nrelayed\r\n')
+
+    def test_idle_abort(self):
+        saved = o2pop.args.idle_timeout
+        self.addCleanup(setattr, o2pop.args, 'idle_timeout', saved)
+        o2pop.args.idle_timeout = 0.2
+        self.assertEqual(asyncio.run(run_idle(o2pop.relay)), ['local', 'remote'])
+        self.assertEqual(asyncio.run(run_idle(o2pop.relay_streams)), ['local', 'remote'])
+
+    def test_stream_handoff(self):
+        async def check():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'data')
+            reader.feed_eof()
+            class Writer:
+                transport = asyncio.Transport()
+            self.assertEqual(o2pop.stream_handoff(reader, Writer), (b'data', True))
+            self.assertIsNone(o2pop.stream_handoff(PlainReader(reader), Writer))
+        asyncio.run(check())
+
+if __name__ == '__main__':
+    unittest.main()